@@ -0,0 +1,86 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+Encode/decode throughput of the forest.cryptography value envelopes.
+Compares v1 (base58) and v2 (binary envelope as base64) on JSON payloads shaped
+like aPersistDict blobs, reporting MB/s and encoded size. Results are JSON.
+
+python -m benchmarks.bench_envelope --sizes 1024 16384 131072 --output envelope.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from typing import Callable
+
+from forest import cryptography
+
+
+def payload(size: int) -> str:
+    "A JSON dict of user -> list of ids about size bytes long, like a pdict blob"
+    entries: dict[str, list[str]] = {}
+    while len(json.dumps(entries)) < size:
+        entries[f"+1555{len(entries):07d}"] = [os.urandom(8).hex() for _ in range(3)]
+    return json.dumps(entries)
+
+
+def throughput(func: Callable[[], object], size: int, min_seconds: float) -> float:
+    "MB/s of cleartext processed by func, repeated for at least min_seconds"
+    runs, start = 0, time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < min_seconds or runs < 3:
+        func()
+        runs += 1
+    return round(size * runs / elapsed / 1e6, 3)
+
+
+def bench(size: int, version: int, min_seconds: float) -> dict:
+    cryptography.ENVELOPE_VERSION = version
+    cleartext = payload(size)
+    encoded = cryptography.get_ciphertext_value(cleartext)
+    assert cryptography.get_cleartext_value(encoded) == cleartext
+    return {
+        "version": version,
+        "cleartext_bytes": len(cleartext),
+        "encoded_bytes": len(encoded),
+        "encode_mb_s": throughput(
+            lambda: cryptography.get_ciphertext_value(cleartext),
+            len(cleartext),
+            min_seconds,
+        ),
+        "decode_mb_s": throughput(
+            lambda: cryptography.get_cleartext_value(encoded),
+            len(cleartext),
+            min_seconds,
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 16384, 131072])
+    parser.add_argument("--versions", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--min-seconds", type=float, default=1.0)
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+    results = {
+        "python": platform.python_version(),
+        "timestamp": int(time.time()),
+        "results": [
+            bench(size, version, args.min_seconds)
+            for size in args.sizes
+            for version in args.versions
+        ],
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
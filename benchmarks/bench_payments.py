@@ -0,0 +1,394 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+Payment throughput benchmarks for PayBot.
+Runs send_payment, build_gift_code, handle_payment and mass payouts against the
+local full-service simulator and a fake signal client, then reports operations per
+second, p50/p95/p99 latency per stage and full-service calls per operation.
+Results are written as JSON so runs can be compared across changes.
+
+python -m benchmarks.bench_payments --payments 100 --output before.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+# must be set before forest reads its config
+os.environ["ENV"] = "test"
+os.environ["SIGNAL"] = "signal-cli"
+os.environ.setdefault("FIXED_RATE", "14.0")
+os.environ.setdefault("ADMIN", "+15555550101")
+# forest.payouts imports forest.pdictng, which needs this; no dicts are created
+os.environ.setdefault("PAUTH", "bench")
+
+# pylint: disable=wrong-import-position
+import mc_util
+from forest import core, payments_monitor, payouts
+from forest.core import Message, PayBot
+from forest.mock_full_service import FullServiceSimulator, random_address
+
+PMOB = 10**12
+BOT_NUMBER = "+15555550100"
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    "count and p50/p95/p99 of samples, in milliseconds"
+    if len(samples) < 2:
+        value = samples[0] * 1000 if samples else 0.0
+        return {"n": len(samples), "p50": value, "p95": value, "p99": value}
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "n": len(samples),
+        "p50": round(cuts[49] * 1000, 2),
+        "p95": round(cuts[94] * 1000, 2),
+        "p99": round(cuts[98] * 1000, 2),
+    }
+
+
+class NullLedger:
+    "Stands in for LedgerManager without a DATABASE_URL, so ledger writes aren't measured"
+
+    async def put_pmob_tx(self, *_: Any) -> None:
+        return None
+
+
+class BenchBot(PayBot):
+    """PayBot that talks to a fake signal client instead of a signal-cli process,
+    and times each stage of the payment flow"""
+
+    def __init__(self, signal_latency: float = 0.0) -> None:
+        self.signal_latency = signal_latency
+        self.stages: dict[str, list[float]] = {}
+        # recipient -> b64 address their "profile" advertises
+        self.profiles: dict[str, str] = {}
+        super().__init__(BOT_NUMBER)
+        if not os.getenv("DATABASE_URL"):
+            self.mobster.ledger_manager = NullLedger()  # type: ignore
+
+    async def timed(self, stage: str, coro: Awaitable[Any]) -> Any:
+        start = time.time()
+        try:
+            return await coro
+        finally:
+            self.stages.setdefault(stage, []).append(time.time() - start)
+
+    async def start_process(self) -> None:
+        "Answer whatever the bot would have sent to signal-cli"
+        while True:
+            command = await self.outbox.get()
+            asyncio.create_task(self.fake_signal_reply(command))
+
+    async def fake_signal_reply(self, command: dict) -> None:
+        if self.signal_latency:
+            await asyncio.sleep(self.signal_latency)
+        result: Any = {"timestamp": int(time.time() * 1000)}
+        if command["method"] == "listContacts":
+            address = self.profiles.get(command["params"]["recipient"])
+            result = [{"profile": {"mobileCoinAddress": address}}]
+        await self.enqueue_blob_messages(
+            {"jsonrpc": "2.0", "id": command["id"], "result": result}
+        )
+
+    async def get_signalpay_address(self, recipient: str) -> Optional[str]:
+        return await self.timed("lookup", super().get_signalpay_address(recipient))
+
+    async def mob_request(self, method: str, **params: Any) -> dict:
+        return await self.timed(method, super().mob_request(method, **params))
+
+    async def confirm_tx_timeout(self, tx_id: str, recipient: str, timeout: int) -> str:
+        return await self.timed(
+            "confirm", super().confirm_tx_timeout(tx_id, recipient, timeout)
+        )
+
+    async def notify_payment(
+        self, recipient: str, full_service_receipt: dict, receipt_message: str
+    ) -> Message:
+        return await self.timed(
+            "notify",
+            super().notify_payment(recipient, full_service_receipt, receipt_message),
+        )
+
+    def add_recipient(self, number: str) -> None:
+        b58 = random_address()
+        self.profiles[number] = mc_util.b58_wrapper_to_b64_public_address(b58) or ""
+
+    async def stop(self) -> None:
+        "Cancel the bot's background tasks before the loop closes"
+        # like a second ctrl-c, so restart_task_callback doesn't restart them
+        self.sigints = 2
+        tasks = [
+            task
+            for task in (
+                self.handle_messages_task,
+                self.restart_task,
+                self.active_users_task,
+                self.utxos.task,
+            )
+            if task
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def recipients(count: int) -> list[str]:
+    return [f"+1555{i:07d}" for i in range(count)]
+
+
+async def run_concurrently(
+    count: int, concurrency: int, op: Callable[[int], Awaitable[bool]]
+) -> tuple[list[float], int]:
+    "run op(0..count) at most concurrency at a time, returning latencies and failures"
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    failures = 0
+
+    async def one(i: int) -> None:
+        nonlocal failures
+        async with semaphore:
+            start = time.time()
+            try:
+                ok = await op(i)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("operation %s failed", i)
+                ok = False
+            latencies.append(time.time() - start)
+            failures += not ok
+
+    await asyncio.gather(*map(one, range(count)))
+    return latencies, failures
+
+
+class Scenario:
+    "Collects one scenario's timings and the full-service calls it made"
+
+    def __init__(self, name: str, bot: BenchBot, sim: FullServiceSimulator) -> None:
+        self.name, self.bot, self.sim = name, bot, sim
+
+    def __enter__(self) -> "Scenario":
+        self.bot.stages = {}
+        self.requests = dict(self.sim.requests)
+        self.posts = self.sim.posts
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.elapsed = time.time() - self.start
+
+    def result(self, latencies: list[float], failures: int) -> dict:
+        count = len(latencies)
+        succeeded = count - failures
+        calls = {
+            method: total - self.requests.get(method, 0)
+            for method, total in self.sim.requests.items()
+            if total - self.requests.get(method, 0)
+        }
+        result = {
+            "count": count,
+            "succeeded": succeeded,
+            "failures": failures,
+            "seconds": round(self.elapsed, 3),
+            # only operations that went through count towards throughput
+            "per_second": round(succeeded / self.elapsed, 2) if self.elapsed else 0,
+            "latency_ms": percentiles(latencies),
+            "stages_ms": {
+                stage: percentiles(samples)
+                for stage, samples in sorted(self.bot.stages.items())
+            },
+            "full_service_calls": calls,
+            "calls_per_op": round(sum(calls.values()) / max(count, 1), 2),
+            "http_requests_per_op": round(
+                (self.sim.posts - self.posts) / max(count, 1), 2
+            ),
+        }
+        logging.info("%s: %s", self.name, json.dumps(result))
+        return result
+
+
+async def bench_send_payment(
+    bot: BenchBot, sim: FullServiceSimulator, args: argparse.Namespace
+) -> dict:
+    targets = recipients(args.payments)
+
+    async def pay(i: int) -> bool:
+        result = await bot.send_payment(targets[i], args.amount_pmob)
+        return bool(result and result.status == "tx_status_succeeded")
+
+    with Scenario("send_payment", bot, sim) as scenario:
+        latencies, failures = await run_concurrently(
+            args.payments, args.concurrency, pay
+        )
+    return scenario.result(latencies, failures)
+
+
+async def bench_gift_codes(
+    bot: BenchBot, sim: FullServiceSimulator, args: argparse.Namespace
+) -> dict:
+    async def gift(_: int) -> bool:
+        return bool((await bot.build_gift_code(args.amount_pmob))[1])
+
+    with Scenario("build_gift_code", bot, sim) as scenario:
+        latencies, failures = await run_concurrently(
+            args.gift_codes, args.concurrency, gift
+        )
+    return scenario.result(latencies, failures)
+
+
+async def bench_receipts(
+    bot: BenchBot, sim: FullServiceSimulator, args: argparse.Namespace
+) -> dict:
+    senders = recipients(args.receipts)
+    messages = [
+        core.MessageParser(
+            {
+                "envelope": {
+                    "source": sender,
+                    "sourceUuid": sender,
+                    "timestamp": int(time.time() * 1000),
+                    "dataMessage": {
+                        "payment": {
+                            "note": "bench",
+                            "receipt": sim.incoming_payment(args.amount_pmob),
+                        }
+                    },
+                }
+            }
+        )
+        for sender in senders
+    ]
+
+    async def receive(i: int) -> bool:
+        await bot.timed("handle_payment", bot.handle_payment(messages[i]))
+        return True
+
+    with Scenario("handle_payment", bot, sim) as scenario:
+        latencies, failures = await run_concurrently(
+            args.receipts, args.concurrency, receive
+        )
+    return scenario.result(latencies, failures)
+
+
+async def bench_payouts(
+    bot: BenchBot, sim: FullServiceSimulator, args: argparse.Namespace
+) -> dict:
+    targets = recipients(args.payouts)
+    latencies: list[float] = []
+
+    async def pay(target: str, txo: str) -> bool:
+        start = time.time()
+        result = await bot.send_payment(
+            target, args.amount_pmob, input_txo_ids=[txo], confirm_tx_timeout=60
+        )
+        latencies.append(time.time() - start)
+        return bool(result and result.status == "tx_status_succeeded")
+
+    async def report(text: str) -> None:
+        logging.info(text)
+
+    engine = payouts.PayoutEngine(bot.utxos, concurrency=args.concurrency)
+    with Scenario("payouts", bot, sim) as scenario:
+        failed = await engine.run(
+            targets, args.amount_pmob + core.FEE_PMOB, pay, report
+        )
+    return scenario.result(latencies, len(failed))
+
+
+BENCHMARKS = {
+    "send_payment": bench_send_payment,
+    "build_gift_code": bench_gift_codes,
+    "handle_payment": bench_receipts,
+    "payouts": bench_payouts,
+}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+async def main(args: argparse.Namespace) -> dict:
+    sim = FullServiceSimulator(
+        balance_pmob=args.balance_mob * PMOB,
+        txo_count=args.txos,
+        block_time=args.block_time,
+        latency=args.latency,
+        failure_rate=args.failure_rate,
+        # PayBot doesn't reserve inputs for single payments or gift codes, so
+        # concurrent ones would otherwise all pick the same largest TXO
+        exclude_proposed=not args.collide,
+    )
+    runner = await sim.start(args.port)
+    bot = BenchBot(args.signal_latency)
+    for number in recipients(max(args.payments, args.payouts)):
+        bot.add_recipient(number)
+    scenarios = {}
+    try:
+        for name in args.only or BENCHMARKS:
+            scenarios[name] = await BENCHMARKS[name](bot, sim, args)
+    finally:
+        await bot.stop()
+        await payments_monitor.close_full_service_clients()
+        await bot.client_session.close()
+        await runner.cleanup()
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "ledger": "postgres" if os.getenv("DATABASE_URL") else "skipped",
+        "timestamp": int(time.time()),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "scenarios": scenarios,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--payments", type=int, default=50)
+    parser.add_argument("--gift-codes", type=int, default=20)
+    parser.add_argument("--receipts", type=int, default=50)
+    parser.add_argument("--payouts", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--amount-pmob", type=int, default=PMOB // 1000)
+    parser.add_argument("--balance-mob", type=int, default=10_000)
+    parser.add_argument("--txos", type=int, default=100)
+    parser.add_argument("--block-time", type=float, default=0.5)
+    parser.add_argument("--latency", type=float, default=0.01, help="full-service")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--collide",
+        action="store_true",
+        help="pick inputs like full-service, even if another proposal uses them",
+    )
+    parser.add_argument("--signal-latency", type=float, default=0.01)
+    parser.add_argument("--port", type=int, default=9191)
+    parser.add_argument("--only", nargs="*", choices=list(BENCHMARKS))
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+    os.environ["FULL_SERVICE_URL"] = f"http://127.0.0.1:{args.port}"
+    return args
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    results = asyncio.run(main(arguments))
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
@@ -0,0 +1,148 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+Cache of recipients' Signal Pay (MobileCoin) addresses.
+Looking an address up costs a round trip through the signal client, so addresses
+are kept for ADDRESS_CACHE_TTL and persisted to postgres to survive restarts.
+Users without payments enabled are remembered for a shorter NEGATIVE_CACHE_TTL.
+An entry is dropped when the user's profile key changes, since their profile
+(and so their address) may have too.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+import asyncpg
+
+from forest import pghelp, utils
+
+ADDRESS_CACHE_TTL = float(utils.get_secret("ADDRESS_CACHE_TTL") or 86400)
+NEGATIVE_CACHE_TTL = float(utils.get_secret("NEGATIVE_CACHE_TTL") or 600)
+
+AddressQueries = pghelp.PGExpressions(
+    table="signalpay_addresses",
+    create_table="CREATE TABLE IF NOT EXISTS {self.table} (\
+        recipient TEXT PRIMARY KEY, \
+        address TEXT, \
+        profile_key TEXT, \
+        updated TIMESTAMP DEFAULT now());",
+    get_addresses="SELECT recipient, address, profile_key, \
+        EXTRACT(EPOCH FROM now() - updated) AS age FROM {self.table} \
+        WHERE updated > now() - $1::FLOAT * INTERVAL '1 second'",
+    put_address="INSERT INTO {self.table} (recipient, address, profile_key, updated) \
+        VALUES ($1, $2, $3, now()) ON CONFLICT (recipient) DO UPDATE \
+        SET address=$2, profile_key=$3, updated=now();",
+    delete_address="DELETE FROM {self.table} WHERE recipient=$1",
+)
+
+
+class CachedAddress:
+    def __init__(
+        self,
+        address: Optional[str],
+        profile_key: Optional[str] = None,
+        fetched: Optional[float] = None,
+    ) -> None:
+        self.address = address
+        self.profile_key = profile_key
+        self.fetched = fetched or time.time()
+
+    def fresh(self) -> bool:
+        ttl = ADDRESS_CACHE_TTL if self.address else NEGATIVE_CACHE_TTL
+        return time.time() - self.fetched < ttl
+
+
+class AddressCache:
+    """Recipient -> b58 address, with None meant as "doesn't have payments enabled"."""
+
+    def __init__(self, database: str = "") -> None:
+        self.interface = (
+            pghelp.PGInterface(query_strings=AddressQueries, database=database)
+            if database
+            else None
+        )
+        self.entries: dict[str, CachedAddress] = {}
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+    async def load(self) -> None:
+        async with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            if not self.interface:
+                return
+            now = time.time()
+            try:
+                records = await self.interface.get_addresses(ADDRESS_CACHE_TTL)
+            except (OSError, asyncpg.PostgresError):
+                logging.exception("couldn't load cached addresses")
+                return
+            for record in records or []:
+                self.entries[record.get("recipient")] = CachedAddress(
+                    record.get("address"),
+                    record.get("profile_key"),
+                    now - float(record.get("age")),
+                )
+            logging.info("loaded %s cached addresses", len(self.entries))
+
+    async def get(
+        self, recipient: str, fetch: Callable[[], Awaitable[Optional[str]]]
+    ) -> Optional[str]:
+        "Returns the cached address for recipient, calling fetch if it's missing or stale"
+        await self.load()
+        entry = self.entries.get(recipient)
+        if entry and entry.fresh():
+            return entry.address
+        address = await fetch()
+        profile_key = entry.profile_key if entry else None
+        self.entries[recipient] = CachedAddress(address, profile_key)
+        await self.persist(recipient)
+        return address
+
+    async def persist(self, recipient: str) -> None:
+        if not self.interface:
+            return
+        try:
+            if recipient in self.entries:
+                entry = self.entries[recipient]
+                await self.interface.put_address(
+                    recipient, entry.address, entry.profile_key
+                )
+            else:
+                await self.interface.delete_address(recipient)
+        except (OSError, asyncpg.PostgresError):
+            logging.exception("couldn't persist address for %s", recipient)
+
+    async def invalidate(self, recipient: str) -> None:
+        if self.entries.pop(recipient, None):
+            await self.persist(recipient)
+
+    async def saw_profile_key(
+        self, recipients: list[str], profile_key: Optional[str]
+    ) -> None:
+        "Drop cached addresses for a user whose profile key no longer matches"
+        if not profile_key:
+            return
+        await self.load()
+        for recipient in filter(None, recipients):
+            entry = self.entries.get(recipient)
+            if not entry or entry.profile_key == profile_key:
+                continue
+            if entry.profile_key is None:
+                # first time we've seen their key
+                entry.profile_key = profile_key
+                await self.persist(recipient)
+            else:
+                logging.info("profile key changed for %s", recipient)
+                await self.invalidate(recipient)
+
+    async def saw_payment(self, recipients: list[str]) -> None:
+        "Anyone who can send a payment has payments enabled"
+        for recipient in filter(None, recipients):
+            entry = self.entries.get(recipient)
+            if entry and not entry.address:
+                await self.invalidate(recipient)
@@ -0,0 +1,168 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+Active user analytics with HyperLogLog sketches.
+Each day gets a fixed-size sketch of the (salted) users seen that day. Sketches are
+merged into postgres periodically, so writes don't scale with the number of users,
+and daily/weekly/monthly actives are estimated by merging the relevant days.
+"""
+
+import asyncio
+import datetime
+import hashlib
+import logging
+import math
+from typing import Optional
+
+import asyncpg
+
+from forest import pghelp, utils
+
+# 2**14 one-byte registers: 16KiB per sketch, ~0.8% standard error
+PRECISION = 14
+FLUSH_INTERVAL = int(utils.get_secret("ACTIVITY_FLUSH_INTERVAL") or 60)
+RETENTION_DAYS = 31
+
+SketchQueries = pghelp.PGExpressions(
+    table="user_activity_sketches",
+    create_table="CREATE TABLE IF NOT EXISTS {self.table} (\
+        bot TEXT NOT NULL, \
+        day DATE NOT NULL, \
+        registers BYTEA NOT NULL, \
+        updated TIMESTAMP DEFAULT now(), \
+        PRIMARY KEY (bot, day));",
+    get_sketches="SELECT day, registers FROM {self.table} WHERE bot=$1 AND day >= $2",
+    lock_sketch="SELECT registers FROM {self.table} WHERE bot=$1 AND day=$2 FOR UPDATE",
+    put_sketch="INSERT INTO {self.table} (bot, day, registers, updated) \
+        VALUES ($1, $2, $3, now()) ON CONFLICT (bot, day) DO UPDATE \
+        SET registers=$3, updated=now();",
+)
+
+
+class HyperLogLog:
+    """Fixed-size cardinality estimator. Merging two sketches gives the sketch of the union."""
+
+    def __init__(self, registers: Optional[bytes] = None, precision: int = PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers or self.size)
+        if len(self.registers) != self.size:
+            raise ValueError(
+                f"expected {self.size} registers, got {len(self.registers)}"
+            )
+
+    def add(self, item: str) -> None:
+        hashed = int.from_bytes(hashlib.sha256(item.encode()).digest()[:8], "big")
+        index = hashed >> (64 - self.precision)
+        remainder = hashed & ((1 << (64 - self.precision)) - 1)
+        # position of the leftmost 1 bit in the remaining bits
+        rank = (64 - self.precision) - remainder.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        """Fold other into this sketch in place and return it"""
+        if other.size != self.size:
+            raise ValueError("can't merge sketches of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size**2 / sum(2.0**-rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        # linear counting is more accurate for small cardinalities
+        if estimate <= 2.5 * self.size and zeros:
+            estimate = self.size * math.log(self.size / zeros)
+        return round(estimate)
+
+    def __bytes__(self) -> bytes:
+        return bytes(self.registers)
+
+
+def today() -> datetime.date:
+    return datetime.datetime.utcnow().date()
+
+
+class ActiveUsers:
+    """Tracks active users per UTC day. Call add() for every message,
+    run() in the background to persist sketches, and count() to query."""
+
+    def __init__(self, bot: str, database: str = "") -> None:
+        self.bot = bot
+        self.interface = (
+            pghelp.PGInterface(query_strings=SketchQueries, database=database)
+            if database
+            else None
+        )
+        self.sketches: dict[datetime.date, HyperLogLog] = {}
+        self.dirty: set[datetime.date] = set()
+
+    def add(self, user: str) -> None:
+        day = today()
+        self.sketches.setdefault(day, HyperLogLog()).add(user)
+        self.dirty.add(day)
+
+    def count(self, days: int = 1) -> int:
+        """Estimated distinct users over the last `days` days, including today"""
+        union = HyperLogLog()
+        for offset in range(days):
+            day = today() - datetime.timedelta(days=offset)
+            if day in self.sketches:
+                union.merge(self.sketches[day])
+        return union.count()
+
+    async def load(self) -> None:
+        """Load persisted sketches for the retention window"""
+        if not self.interface:
+            return
+        since = today() - datetime.timedelta(days=RETENTION_DAYS)
+        for record in await self.interface.get_sketches(self.bot, since) or []:
+            stored = HyperLogLog(record.get("registers"))
+            self.sketches.setdefault(record.get("day"), HyperLogLog()).merge(stored)
+        logging.info("loaded %s days of activity sketches", len(self.sketches))
+
+    async def persist(self) -> None:
+        """Merge each dirty day's sketch with the stored one (other nodes may have written it)
+        and write it back. One row write per day per flush, regardless of user count."""
+        if not self.interface:
+            self.dirty.clear()
+            return
+        unwritten, self.dirty = set(self.dirty), set()
+        try:
+            for day in list(unwritten):
+                sketch = self.sketches.get(day)
+                if sketch is None:
+                    # pruned since it was marked dirty
+                    unwritten.discard(day)
+                    continue
+                async with self.interface.transaction() as txn:
+                    stored = await txn.lock_sketch(self.bot, day)
+                    if stored:
+                        sketch.merge(HyperLogLog(stored[0].get("registers")))
+                    await txn.put_sketch(self.bot, day, bytes(sketch))
+                unwritten.discard(day)
+        finally:
+            # whatever wasn't written is tried again next flush
+            self.dirty |= unwritten
+
+    def prune(self) -> None:
+        cutoff = today() - datetime.timedelta(days=RETENTION_DAYS)
+        # days still waiting to be written are kept until they are
+        for day in [day for day in self.sketches if day < cutoff]:
+            if day not in self.dirty:
+                self.sketches.pop(day)
+
+    async def run(self) -> None:
+        try:
+            await self.load()
+        except (OSError, asyncpg.PostgresError):
+            logging.exception("couldn't load activity sketches")
+        while 1:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self.persist()
+            except (OSError, asyncpg.PostgresError):
+                logging.exception("couldn't persist activity sketches")
+            self.prune()
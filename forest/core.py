@@ -52,7 +52,18 @@ from ulid2 import generate_ulid_as_base32 as get_uid
 
 # framework
 import mc_util
-from forest import autosave, datastore, payments_monitor, pghelp, string_dist, utils
+from forest import (
+    address_cache,
+    analytics,
+    autosave,
+    datastore,
+    payments_monitor,
+    pghelp,
+    rates,
+    string_dist,
+    utils,
+    utxo,
+)
 from forest.cryptography import hash_salt
 from forest.message import AuxinMessage, Message, StdioMessage
 
@@ -68,10 +79,15 @@ Command = Callable[["Bot", Message], Coroutine[Any, Any, Response]]
 
 roundtrip_histogram = Histogram("roundtrip_h", "Roundtrip message response time")
 roundtrip_summary = Summary("roundtrip_s", "Roundtrip message response time")
+payment_stage_latency = Histogram(
+    "payment_stage_seconds", "Time spent in each send_payment stage", ["stage"]
+)
 
 MessageParser = AuxinMessage if utils.AUXIN else StdioMessage
 logging.info("Using message parser: %s", MessageParser)
 FEE_PMOB = int(1e12 * 0.0004)
+# a transaction has at most 16 outputs, one of which is change
+MAX_OUTPUTS = 15
 
 
 def rpc(
@@ -119,19 +135,6 @@ async def get_attachment_paths(message: Message) -> list[str]:
     return attachments
 
 
-ActivityQueries = pghelp.PGExpressions(
-    table="user_activity",
-    create_table="""CREATE TABLE user_activity (
-        id SERIAL PRIMARY KEY,
-        account TEXT,
-        first_seen TIMESTAMP default now(),
-        last_seen TIMESTAMP default now(),
-        bot TEXT,
-        UNIQUE (account, bot));""",
-    log="""INSERT INTO user_activity (account, bot) VALUES ($1, $2)
-    ON CONFLICT ON CONSTRAINT user_activity_account_bot_key1 DO UPDATE SET last_seen=now()""",
-)
-
 # This software is intended to promote growth. Like a well managed forest, it grows, it nurtures, it kills.
 # Attempts to use this software in a destructive matter, or attempts to harm the forest will be thwarted.
 ########################################°–_⛤_–°#########################################################
@@ -240,6 +243,12 @@ class Signal:
         Upload our datastore, close postgres connections pools, kill signal, kill autosave, exit
         """
         logging.info("starting async_shutdown")
+        # only loaded by bots that use persistent dicts, since importing it needs PAUTH
+        if pdictng := sys.modules.get("forest.pdictng"):
+            try:
+                await pdictng.flush_all()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("couldn't flush persistent dicts")
         # if we're downloading, then we upload too
         if utils.UPLOAD:
             await self.datastore.upload()
@@ -254,6 +263,9 @@ class Signal:
                 logging.info(f"no {utils.SIGNAL} process")
         if utils.UPLOAD:
             await self.datastore.mark_freed()
+        await payments_monitor.close_full_service_clients()
+        await rates.rate_service.close()
+        await pghelp.change_feed.close()
         await pghelp.pool.close()
         # this still deadlocks. see https://github.com/forestcontact/forest-draft/issues/10
         if autosave._memfs_process:
@@ -721,12 +733,12 @@ class Bot(Signal):
             if not hasattr(getattr(self, f"do_{name}"), "hide")
         ]
         super().__init__(bot_number)
-        self.activity = pghelp.PGInterface(
-            query_strings=ActivityQueries, database=utils.get_secret("DATABASE_URL")
+        # sketches of the users we've received messages from, for signup metrics
+        self.active_users = analytics.ActiveUsers(
+            utils.APP_NAME or "", utils.get_secret("DATABASE_URL")
         )
-        # set of users we've received messages from in the last minute
-        self.seen_users: set[str] = set()
-        self.log_activity_task = asyncio.create_task(self.log_activity())
+        self.active_users_task = asyncio.create_task(self.active_users.run())
+        self.active_users_task.add_done_callback(self.log_task_result)
         self.restart_task = asyncio.create_task(
             self.start_process()
         )  # maybe cancel on sigint?
@@ -737,33 +749,6 @@ class Bot(Signal):
             self.restart_task_callback(self.handle_messages)
         )
 
-    async def log_activity(self) -> None:
-        """
-        every 60s, update the user_activity table with users we've seen
-        runs in the bg as batches to avoid a seperate db query for every message
-        used for signup metrics
-        """
-        if not self.activity.pool:
-            await self.activity.connect_pg()
-            # mypy can't infer that connect_pg creates pool
-            assert self.activity.pool
-        while 1:
-            await asyncio.sleep(60)
-            if not self.seen_users:
-                continue
-            try:
-                async with pghelp.pool.acquire() as conn:
-                    # executemany batches this into an atomic db query
-                    await conn.executemany(
-                        self.activity.queries["log"],
-                        [(name, utils.APP_NAME) for name in self.seen_users],
-                    )
-                    logging.debug("recorded %s seen users", len(self.seen_users))
-                    self.seen_users = set()
-            except asyncpg.UndefinedTableError:
-                logging.info("creating user_activity table")
-                await self.activity.create_table()
-
     async def handle_messages(self) -> None:
         """
         Read messages from the queue. If it matches a pending request to auxin-cli/signal-cli,
@@ -774,7 +759,7 @@ class Bot(Signal):
         while True:
             message = await self.inbox.get()
             if metrics_salt and message.uuid:
-                self.seen_users.add(hash_salt(message.uuid, metrics_salt))
+                self.active_users.add(hash_salt(message.uuid, metrics_salt))
             if message.id and message.id in self.pending_requests:
                 logging.debug("setting result for future %s: %s", message.id, message)
                 self.pending_requests[message.id].set_result(message)
@@ -965,6 +950,28 @@ class Bot(Signal):
                 return exception_traceback
         return None
 
+    @requires_admin
+    async def do_active_users(self, _: Message) -> Response:
+        """Estimated daily, weekly and monthly active users (to within about 1%)."""
+        return (
+            f"daily: {self.active_users.count(1)}, "
+            f"weekly: {self.active_users.count(7)}, "
+            f"monthly: {self.active_users.count(30)}"
+        )
+
+    @requires_admin
+    async def do_slow_queries(self, msg: Message) -> Response:
+        """slow_queries [n]
+        Lists the n postgres expressions with the highest mean latency since startup."""
+        limit = int(msg.arg1) if msg.arg1 and msg.arg1.isnumeric() else 10
+        stats = pghelp.slowest_queries(limit)
+        if not stats:
+            return "No queries recorded yet"
+        return "\n".join(
+            f"{name}: mean {mean:.4f}s, max {max_:.4f}s over {calls} calls"
+            for name, calls, mean, max_ in stats
+        )
+
     def get_recipients(self) -> list[dict[str, str]]:
         """Returns a list of all known recipients by parsing underlying datastore."""
         return json.loads(
@@ -1065,6 +1072,13 @@ def compose_payment_content(receipt: str, note: str) -> dict:
 
 
 class PayBot(ExtrasBot):
+    def __init__(self, bot_number: Optional[str] = None) -> None:
+        super().__init__(bot_number)
+        self.utxos = utxo.UTXOManager(self.mobster)
+        self.address_cache = address_cache.AddressCache(
+            utils.get_secret("DATABASE_URL")
+        )
+
     @requires_admin
     async def do_fsr(self, msg: Message) -> Response:
         """
@@ -1098,8 +1112,27 @@ class PayBot(ExtrasBot):
         """Returns bot balance in MOB."""
         return f"Bot has balance of {mc_util.pmob2mob(await self.mobster.get_balance()).quantize(Decimal('1.0000'))} MOB"
 
+    @requires_admin
+    async def do_reconcile_ledger(self, msg: Message) -> Response:
+        """reconcile_ledger [fix]
+        Checks materialized account balances against the raw ledger. Pass "fix" to rebuild them."""
+        fix = (msg.arg1 or "").lower() == "fix"
+        mismatches = await self.mobster.ledger_manager.reconcile(fix=fix)
+        if not mismatches:
+            return "Balances match the ledger"
+        lines = [
+            f"{row['account']}: ledger {row['ledger_usd_cents']}c/{row['ledger_pmob']}pmob, "
+            f"balance {row['balance_usd_cents']}c/{row['balance_pmob']}pmob"
+            for row in mismatches
+        ]
+        verb = "Rebuilt" if fix else "Found"
+        return f"{verb} {len(mismatches)} mismatched balances:\n" + "\n".join(lines)
+
     async def handle_message(self, message: Message) -> Response:
+        senders = [message.source, message.uuid]
+        await self.address_cache.saw_profile_key(senders, message.profile_key)
         if message.payment:
+            await self.address_cache.saw_payment(senders)
             asyncio.create_task(self.handle_payment(message))
             return None
         return await super().handle_message(message)
@@ -1143,7 +1176,13 @@ class PayBot(ExtrasBot):
         return f"Thank you for sending {float(amount_mob)} MOB ({amount_usd} USD)"
 
     async def get_signalpay_address(self, recipient: str) -> Optional[str]:
-        "get a receipient's mobilecoin address"
+        "get a receipient's mobilecoin address, cached"
+        return await self.address_cache.get(
+            recipient, lambda: self.fetch_signalpay_address(recipient)
+        )
+
+    async def fetch_signalpay_address(self, recipient: str) -> Optional[str]:
+        "ask the signal client for a receipient's mobilecoin address"
         if utils.AUXIN:
             result = await self.signal_rpc_request("getPayAddress", peer_name=recipient)
             b64_address = (
@@ -1234,74 +1273,91 @@ class PayBot(ExtrasBot):
 
     async def confirm_tx_timeout(self, tx_id: str, recipient: str, timeout: int) -> str:
         logging.debug("Attempting to confirm tx status for %s", recipient)
-        status = "tx_status_pending"
-        for i in range(timeout):
-            tx_status = await self.mob_request(
-                "get_transaction_log", transaction_log_id=tx_id
+        tx_log = await self.mobster.transaction_watcher.wait(tx_id, timeout)
+        status = tx_log.get("status", "tx_status_pending")
+        if status == "tx_status_succeeded":
+            logging.info("Tx to %s suceeded - tx data: %s", recipient, tx_log)
+        elif status == "tx_status_failed":
+            logging.warning("Tx to %s failed - tx data: %s", recipient, tx_log)
+        else:
+            logging.warning("Tx to %s timed out - tx data: %s", recipient, tx_log)
+        return status
+
+    async def notify_payment(
+        self, recipient: str, full_service_receipt: dict, receipt_message: str
+    ) -> Message:
+        "Send recipient a payment notification for a full-service receiver receipt"
+        # this gets us a Receipt protobuf
+        b64_receipt = mc_util.full_service_receipt_to_b64_receipt(full_service_receipt)
+        if utils.AUXIN:
+            content = compose_payment_content(b64_receipt, receipt_message)
+            # pass our beautifully composed JSON content to auxin.
+            # message body is ignored in this case.
+            payment_notif = await self.send_message(recipient, "", content=content)
+            return await self.wait_for_response(rpc_id=payment_notif)
+        return await self.signal_rpc_request(
+            "sendPaymentNotification",
+            receipt=b64_receipt,
+            note=receipt_message,
+            recipient=recipient,
+        )
+
+    async def build_payment(
+        self, recipient: str, amount_pmob: int, **params: Any
+    ) -> dict:
+        """
+        Build (but don't submit) a payment, returning full-service's tx_proposal and
+        transaction_log_id. Pass the result to send_payment as proposal to submit it later,
+        e.g. to build queued payouts ahead of time. Proposals built ahead of time
+        should each get their own input_txo_ids so they don't spend the same inputs.
+        """
+        with payment_stage_latency.labels("lookup").time():
+            address, account_id = await asyncio.gather(
+                self.get_signalpay_address(recipient), self.mobster.get_account()
             )
-            status = (
-                tx_status.get("result", {}).get("transaction_log", {}).get("status")
+        if not address:
+            raise UserError(
+                "Sorry, couldn't get your MobileCoin address. Please make sure you have payments enabled, and have messaged me from your phone!"
             )
-            if status == "tx_status_succeeded":
-                logging.info(
-                    "Tx to %s suceeded - tx data: %s",
-                    recipient,
-                    tx_status.get("result"),
-                )
-                break
-            if status == "tx_status_failed":
-                logging.warning(
-                    "Tx to %s failed - tx data: %s",
-                    recipient,
-                    tx_status.get("result"),
-                )
-                break
-            await asyncio.sleep(1)
-        if status == "tx_status_pending":
-            logging.warning(
-                "Tx to %s timed out - tx data: %s",
-                recipient,
-                tx_status.get("result"),
+        # TODO: add explicit utxo handling
+        with payment_stage_latency.labels("build").time():
+            raw_prop = await self.mob_request(
+                "build_transaction",
+                account_id=account_id,
+                recipient_public_address=address,
+                value_pmob=str(int(amount_pmob)),
+                fee=str(int(1e12 * 0.0004)),
+                **params,
             )
-        return status
+        return raw_prop.get("result", {})
 
-    # FIXME: clarify signature and return details/docs
-    async def send_payment(  # pylint: disable=too-many-locals
+    async def start_payment(  # pylint: disable=too-many-arguments,too-many-locals
         self,
         recipient: str,
         amount_pmob: int,
         receipt_message: str = "Transaction sent!",
         confirm_tx_timeout: int = 60,
+        proposal: Optional[dict] = None,
         **params: Any,
-    ) -> Optional[Message]:
+    ) -> "asyncio.Future[Optional[Message]]":
         """
-        If confirm_tx_timeout is not 0, we wait that many seconds for the tx
-        to complete before sending receipt_message to receipient
-        params are pasted to the full-service build_transaction call.
-        some useful params are comment and input_txo_ids
+        Like send_payment, but returns as soon as the transaction is submitted.
+        The returned future resolves to what send_payment would have returned once
+        the recipient is notified and (if confirm_tx_timeout) the tx is confirmed.
         """
-        address = await self.get_signalpay_address(recipient)
-        account_id = await self.mobster.get_account()
-        if not address:
-            raise UserError(
-                "Sorry, couldn't get your MobileCoin address. Please make sure you have payments enabled, and have messaged me from your phone!"
-            )
-        # TODO: add explicit utxo handling
-        raw_prop = await self.mob_request(
-            "build_transaction",
-            account_id=account_id,
-            recipient_public_address=address,
-            value_pmob=str(int(amount_pmob)),
-            fee=str(int(1e12 * 0.0004)),
-            **params,
+        result: "asyncio.Future[Optional[Message]]" = (
+            asyncio.get_running_loop().create_future()
         )
-        prop = raw_prop.get("result", {}).get("tx_proposal")
-        tx_id = raw_prop.get("result", {}).get("transaction_log_id")
+        if proposal is None:
+            proposal = await self.build_payment(recipient, amount_pmob, **params)
+        account_id = await self.mobster.get_account()
+        prop = proposal.get("tx_proposal")
+        tx_id = proposal.get("transaction_log_id")
         # this is to NOT log transactions into the full service DB if the sender
         # wants it private.
         if confirm_tx_timeout:
             # putting the account_id into the request logs it to full service,
-            tx_result: Optional[dict] = await self.mob_request(
+            submit = self.mob_request(
                 "submit_transaction",
                 tx_proposal=prop,
                 comment=params.get("comment", ""),
@@ -1310,15 +1366,27 @@ class PayBot(ExtrasBot):
         elif prop and tx_id:
             # if you omit account_id, tx doesn't get logged. Good for privacy,
             # but transactions can't be confirmed by the sending party (you)!
-            tx_result = await self.mob_request("submit_transaction", tx_proposal=prop)
+            submit = self.mob_request("submit_transaction", tx_proposal=prop)
         else:
-            tx_result = {"error": {"message": "InternalError"}}
-        # {'method': 'submit_transaction', 'error': {'code': -32603, 'message': 'InternalError', 'data': {'server_error': 'Database(Diesel(DatabaseError(__Unknown, "database is locked")))', 'details': 'Error interacting with the database: Diesel Error: database is locked'}}, 'jsonrpc': '2.0', 'id': 1}
+            result.set_result(None)
+            return result
+        # receipts only need the proposal, so they're made while it's submitted
+        with payment_stage_latency.labels("submit").time():
+            tx_result, receipts = await asyncio.gather(
+                submit,
+                self.mob_request(
+                    "create_receiver_receipts",
+                    tx_proposal=prop,
+                    account_id=account_id,
+                ),
+            )
+        # {'method': 'submit_transaction', 'error': {'code': -32603, 'message': 'InternalError', 'data': {'server_error': 'Database(Diesel(DatabaseError(__Unknown, "database is locked")))', 'details': 'Error interacting with the database: Diesel Error: database is locked'}}, 'jsonrpc': '2.0', 'id': 1}
         if not tx_result or (
             tx_result.get("error")
             and "InternalError" in tx_result.get("error", {}).get("message", "")
         ):
-            return None
+            result.set_result(None)
+            return result
             # logging.info("InternalError occurred, retrying in 60s")
             # await asyncio.sleep(1)
             # tx_result = await self.mob_request("submit_transaction", tx_proposal=prop)
@@ -1328,41 +1396,172 @@ class PayBot(ExtrasBot):
             logging.warning("tx submit error for tx_id: %s", tx_id)
             msg = MessageParser({})
             msg.status, msg.transaction_log_id = "tx_status_failed", tx_id
-            return msg
-
-        full_service_receipt = (
-            await self.mob_request(
-                "create_receiver_receipts",
-                tx_proposal=prop,
-                account_id=account_id,
-            )
-        )["result"]["receiver_receipts"][0]
-        # this gets us a Receipt protobuf
-        b64_receipt = mc_util.full_service_receipt_to_b64_receipt(full_service_receipt)
-        if utils.AUXIN:
-            content = compose_payment_content(b64_receipt, receipt_message)
-            # pass our beautifully composed JSON content to auxin.
-            # message body is ignored in this case.
-            payment_notif = await self.send_message(recipient, "", content=content)
-            resp_future = asyncio.create_task(
-                self.wait_for_response(rpc_id=payment_notif)
-            )
-        else:
-            resp_future = asyncio.create_task(
-                self.signal_rpc_request(
-                    "sendPaymentNotification",
-                    receipt=b64_receipt,
-                    note=receipt_message,
-                    recipient=recipient,
-                )
+            result.set_result(msg)
+            return result
+        full_service_receipt = receipts["result"]["receiver_receipts"][0]
+        return asyncio.create_task(
+            self.finish_payment(
+                recipient,
+                full_service_receipt,
+                receipt_message,
+                tx_id or "",
+                confirm_tx_timeout,
             )
+        )
+
+    async def finish_payment(  # pylint: disable=too-many-arguments
+        self,
+        recipient: str,
+        full_service_receipt: dict,
+        receipt_message: str,
+        tx_id: str,
+        confirm_tx_timeout: int,
+    ) -> Optional[Message]:
+        "Notify the recipient while waiting for confirmation"
+        notification = asyncio.create_task(
+            self.notify_payment(recipient, full_service_receipt, receipt_message)
+        )
         if confirm_tx_timeout:
-            status = await self.confirm_tx_timeout(tx_id, recipient, confirm_tx_timeout)
-            resp = await resp_future
+            with payment_stage_latency.labels("confirm").time():
+                status = await self.confirm_tx_timeout(
+                    tx_id, recipient, confirm_tx_timeout
+                )
+            # only the part of notifying that didn't overlap with confirmation
+            with payment_stage_latency.labels("notify").time():
+                resp = await notification
             # the calling function can use these to check the payment status
             resp.status, resp.transaction_log_id = status, tx_id  # type: ignore
             return resp
-        return await resp_future
+        with payment_stage_latency.labels("notify").time():
+            return await notification
+
+    # FIXME: clarify signature and return details/docs
+    async def send_payment(  # pylint: disable=too-many-arguments
+        self,
+        recipient: str,
+        amount_pmob: int,
+        receipt_message: str = "Transaction sent!",
+        confirm_tx_timeout: int = 60,
+        proposal: Optional[dict] = None,
+        **params: Any,
+    ) -> Optional[Message]:
+        """
+        If confirm_tx_timeout is not 0, we wait that many seconds for the tx
+        to complete before sending receipt_message to receipient
+        params are pasted to the full-service build_transaction call.
+        some useful params are comment and input_txo_ids
+        proposal can be a prebuilt proposal from build_payment.
+        Use start_payment to get a future instead of waiting for confirmation.
+        """
+        return await (
+            await self.start_payment(
+                recipient,
+                amount_pmob,
+                receipt_message,
+                confirm_tx_timeout,
+                proposal,
+                **params,
+            )
+        )
+
+    async def send_payments(
+        self,
+        payments: list[tuple[str, int]],
+        receipt_message: str = "Transaction sent!",
+        confirm_tx_timeout: int = 60,
+    ) -> list[Optional[Message]]:
+        """
+        Pay many (recipient, amount_pmob) pairs with as few transactions as possible.
+        Recipients are packed MAX_OUTPUTS to a transaction, and each gets their own
+        receipt notification. Returns a result per payment, in order, with status and
+        transaction_log_id set like send_payment; None if the recipient couldn't be paid,
+        or if their transaction was submitted but couldn't be followed up (that's logged
+        with its transaction_log_id).
+        """
+        addresses = await asyncio.gather(
+            *(self.get_signalpay_address(recipient) for recipient, _ in payments)
+        )
+        payable = [
+            (i, recipient, address, amount_pmob)
+            for i, ((recipient, amount_pmob), address) in enumerate(
+                zip(payments, addresses)
+            )
+            if address
+        ]
+        results: dict[int, Message] = {}
+        # built and submitted one at a time so full-service doesn't pick the same inputs twice
+        pending = []
+        for i in range(0, len(payable), MAX_OUTPUTS):
+            chunk = payable[i : i + MAX_OUTPUTS]
+            raw_prop = await self.mobster.build_multi_txo_proposal(
+                [(address, str(int(amount))) for _, _, address, amount in chunk]
+            )
+            prop = raw_prop.get("result", {}).get("tx_proposal")
+            tx_id = raw_prop.get("result", {}).get("transaction_log_id")
+            submitted = (
+                await self.mob_request(
+                    "submit_transaction",
+                    tx_proposal=prop,
+                    account_id=await self.mobster.get_account(),
+                )
+                if prop
+                else {}
+            )
+            if not submitted.get("result"):
+                logging.warning("batch tx submit error for tx_id: %s", tx_id)
+                continue
+            pending.append((chunk, prop, tx_id))
+
+        async def finish(
+            chunk: list[tuple[int, str, str, int]], prop: dict, tx_id: str
+        ) -> None:
+            receipts = (
+                await self.mob_request(
+                    "create_receiver_receipts",
+                    tx_proposal=prop,
+                    account_id=await self.mobster.get_account(),
+                )
+            )["result"]["receiver_receipts"]
+            # match each receipt to its recipient by the public key of their output
+            public_keys = mc_util.tx_proposal_outlay_public_keys(prop)
+            if public_keys is None:
+                logging.warning("tx %s has no outlay mapping, assuming order", tx_id)
+                paid = list(zip(chunk, receipts))
+            else:
+                outlays = dict(zip(public_keys, chunk))
+                paid = [
+                    (outlays[receipt["public_key"]], receipt)
+                    for receipt in receipts
+                    if receipt.get("public_key") in outlays
+                ]
+            notifications = asyncio.gather(
+                *(
+                    self.notify_payment(recipient, receipt, receipt_message)
+                    for (_, recipient, _, _), receipt in paid
+                )
+            )
+            status = "tx_status_pending"
+            if confirm_tx_timeout:
+                status = await self.confirm_tx_timeout(
+                    tx_id, f"{len(chunk)} recipients", confirm_tx_timeout
+                )
+            for ((i, _, _, _), _), resp in zip(paid, await notifications):
+                resp.status, resp.transaction_log_id = status, tx_id  # type: ignore
+                results[i] = resp
+
+        # each chunk was already submitted, so one failing mustn't hide the others
+        outcomes = await asyncio.gather(
+            *(finish(*args) for args in pending), return_exceptions=True
+        )
+        for (chunk, _, tx_id), outcome in zip(pending, outcomes):
+            if isinstance(outcome, Exception):
+                logging.error(
+                    "couldn't finish batch tx %s to %s: %r",
+                    tx_id,
+                    [recipient for _, recipient, _, _ in chunk],
+                    outcome,
+                )
+        return [results.get(i) for i in range(len(payments))]
 
 
 # we should just have either a hasable user type or a mapping subtype
@@ -1904,6 +2103,12 @@ if utils.MEMFS:
 
 def run_bot(bot: Type[Bot], local_app: web.Application = app) -> None:
     async def start_wrapper(our_app: web.Application) -> None:
+        if database := utils.get_secret("DATABASE_URL"):
+            # create tables, indexes and migrations before the first message needs them
+            try:
+                await pghelp.bootstrap_schema(database)
+            except (OSError, asyncpg.PostgresError):
+                logging.exception("couldn't bootstrap schema")
         our_app["bot"] = bot()
 
     local_app.on_startup.append(start_wrapper)
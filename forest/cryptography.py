@@ -1,3 +1,4 @@
+import base64
 import gzip
 import hashlib
 import logging
@@ -38,17 +39,54 @@ def hash_salt(key_: str, salt: str = SALT) -> str:
     return base58.b58encode(hashlib.sha256(f"{salt}{key_}".encode()).digest()).decode()
 
 
+# Envelope v1 is base58(nonce + tag + ciphertext of gzip(value)). base58 is quadratic
+# in the payload size, so v2 is a binary envelope whose header names the codec and cipher:
+# version byte, codec byte, cipher byte, then nonce + tag + ciphertext.
+# As text, v2 is TEXT_PREFIX + base64(envelope); ':' never appears in base58.
+# Readers accept both; set ENVELOPE_VERSION=1 to keep writing v1, e.g. while
+# older deployments still need to read the values.
+ENVELOPE_V2 = 2
+ENVELOPE_VERSION = int(os.getenv("ENVELOPE_VERSION") or ENVELOPE_V2)
+TEXT_PREFIX = f"v{ENVELOPE_V2}:"
+CODEC_RAW, CODEC_GZIP = 0, 1
+CIPHER_AES_EAX = 1
+# smaller values usually grow when gzipped
+COMPRESS_THRESHOLD = 128
+
+
+def seal(data: bytes, key: bytes = AESKEY) -> bytes:
+    """returns a v2 envelope: compressed (if worthwhile) and AES EAX encrypted data"""
+    codec = CODEC_GZIP if len(data) >= COMPRESS_THRESHOLD else CODEC_RAW
+    if codec == CODEC_GZIP:
+        data = gzip.compress(data, compresslevel=6)
+    return bytes([ENVELOPE_V2, codec, CIPHER_AES_EAX]) + encrypt(data, key)
+
+
+def unseal(envelope: bytes, key: bytes = AESKEY) -> bytes:
+    """decrypts and decompresses a v2 envelope"""
+    version, codec, cipher = envelope[:3]
+    known_codec = codec in (CODEC_RAW, CODEC_GZIP)
+    if version != ENVELOPE_V2 or cipher != CIPHER_AES_EAX or not known_codec:
+        raise ValueError(f"unknown envelope {version}/{codec}/{cipher}")
+    data = decrypt(envelope[3:], key)
+    return gzip.decompress(data) if codec == CODEC_GZIP else data
+
+
 def get_ciphertext_value(value_: Union[str, bytes]) -> str:
-    """returns a base58 encoded aes128 AES EAX mode encrypted gzip compressed value"""
+    """returns an encrypted, compressed value as text, in the ENVELOPE_VERSION format"""
     if isinstance(value_, str):
         value_bytes = value_.encode()
     elif isinstance(value_, bytes):
         value_bytes = value_
     else:
         raise ValueError
-    return base58.b58encode(encrypt(gzip.compress(value_bytes), AESKEY)).decode()
+    if ENVELOPE_VERSION == 1:
+        return base58.b58encode(encrypt(gzip.compress(value_bytes), AESKEY)).decode()
+    return TEXT_PREFIX + base64.b64encode(seal(value_bytes)).decode()
 
 
 def get_cleartext_value(value_: str) -> str:
-    """decrypts, decodes, decompresses a b58 blob returning cleartext"""
+    """decrypts, decodes, decompresses a v2 or (b58) v1 value returning cleartext"""
+    if value_.startswith(TEXT_PREFIX):
+        return unseal(base64.b64decode(value_[len(TEXT_PREFIX) :])).decode()
     return gzip.decompress(decrypt(base58.b58decode(value_), AESKEY)).decode()
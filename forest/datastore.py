@@ -57,6 +57,8 @@ AccountPGExpressions = pghelp.PGExpressions(
     is_registered="SELECT datastore is not null as registered FROM {self.table} WHERE id=$1",
     get_datastore=get_datastore,
     get_claim="SELECT active_node_name FROM {self.table} WHERE id=$1",
+    # takes ids, so the unprefixed row MIGRATE falls back to is locked too
+    lock_account="SELECT active_node_name FROM {self.table} WHERE id = ANY($1) FOR UPDATE",
     mark_account_claimed="UPDATE {self.table} \
         SET active_node_name = $2, \
         last_node_name = $2, \
@@ -110,11 +112,13 @@ class SignalDatastore:
             logging.error(e)
             return False
 
-    async def is_claimed(self) -> Optional[str]:
-        record = await self.account_interface.get_claim(self.number)
+    async def is_claimed(self, interface: Any = None) -> Optional[str]:
+        """Returns the node holding our account, optionally checking via a pinned interface"""
+        interface = interface or self.account_interface
+        record = await interface.get_claim(self.number)
         if not record:
             logging.warning("checking claim without plus instead")
-            record = await self.account_interface.get_claim(self.number[1:])
+            record = await interface.get_claim(self.number[1:])
             if record:
                 return record[0].get("active_node_name")
             raise Exception(f"no record in db for {self.number}")
@@ -139,29 +143,31 @@ class SignalDatastore:
             if i == 4:
                 logging.info("time's up")
         logging.info("downloading")
-        record = await self.account_interface.get_datastore(self.number)
-        if not record and utils.get_secret("MIGRATE"):
-            logging.warning("trying without plus")
-            record = await self.account_interface.get_datastore(
-                self.number.removeprefix("+")
+        # fetch, claim and re-check on one connection, holding a row lock so
+        # another node can't claim the account between our fetch and our claim
+        async with self.account_interface.transaction() as txn:
+            await txn.lock_account([self.number, self.number.removeprefix("+")])
+            record = await txn.get_datastore(self.number)
+            if not record and utils.get_secret("MIGRATE"):
+                logging.warning("trying without plus")
+                record = await txn.get_datastore(self.number.removeprefix("+"))
+            logging.info("got datastore from pg")
+            buffer = BytesIO(record[0].get("datastore"))
+            tarball = TarFile(fileobj=buffer)
+            fnames = [member.name for member in tarball.getmembers()]
+            logging.debug(fnames[:2])
+            logging.info(
+                "expected file %s exists: %s",
+                self.filepath,
+                self.filepath in fnames,
             )
-        logging.info("got datastore from pg")
-        buffer = BytesIO(record[0].get("datastore"))
-        tarball = TarFile(fileobj=buffer)
-        fnames = [member.name for member in tarball.getmembers()]
-        logging.debug(fnames[:2])
-        logging.info(
-            "expected file %s exists: %s",
-            self.filepath,
-            self.filepath in fnames,
-        )
-        tarball.extractall(utils.ROOT_DIR)
-        # open("last_downloaded_checksum", "w").write(zlib.crc32(buffer.seek(0).read()))
-        app_prefix = utils.APP_NAME + "-" if utils.APP_NAME else ""
-        node_name = app_prefix + socket.gethostname()
-        await self.account_interface.mark_account_claimed(self.number, node_name)
-        logging.debug("marked account as claimed, asserting that this is the case")
-        assert await self.is_claimed()
+            tarball.extractall(utils.ROOT_DIR)
+            # open("last_downloaded_checksum", "w").write(zlib.crc32(buffer.seek(0).read()))
+            app_prefix = utils.APP_NAME + "-" if utils.APP_NAME else ""
+            node_name = app_prefix + socket.gethostname()
+            await txn.mark_account_claimed(self.number, node_name)
+            logging.debug("marked account as claimed, asserting that this is the case")
+            assert await self.is_claimed(txn)
         return
 
     def tarball_data(self) -> Optional[bytes]:
@@ -74,6 +74,8 @@ class Message(Dictable):
     arg2: Optional[str]
     arg3: Optional[str]
     reactions: dict[str, str]
+    # sender's profile key, if the message carried one
+    profile_key: Optional[str] = None
     # reaction: Optional[Reaction]
     # quote: Optional[Quote]
 
@@ -177,6 +179,7 @@ class AuxinMessage(Message):
             }
         else:
             self.payment = {}
+        self.profile_key = msg.get("profileKey")
         if self.text:
             logging.info(self)  # "parsed a message with body: '%s'", self.text)
         super().__init__(blob)
@@ -233,6 +236,7 @@ class StdioMessage(Message):
         self.quoted_text = msg.get("quote", {}).get("text")
         self.typing = envelope.get("typingMessage", {}).get("action")
         self.payment = msg.get("payment")
+        self.profile_key = msg.get("profileKey")
         try:
             self.quote: Optional[Quote] = Quote(msg.get("quote"))
         except (AssertionError, KeyError):
@@ -0,0 +1,492 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+Local stand-in for a full-service wallet, for load testing payments offline.
+Implements the JSON-RPC methods the framework uses against an in-memory ledger:
+TXOs are spent and created by submitted transactions, which settle when the next
+simulated block is made. Latency and failures can be injected per method.
+
+python -m forest.mock_full_service --port 9090 --latency 0.02 --failure-rate 0.01
+then point FULL_SERVICE_URL at http://localhost:9090
+"""
+
+import argparse
+import asyncio
+import base64
+import itertools
+import logging
+import os
+import random
+from typing import Any, Callable, Optional
+
+from aiohttp import web
+
+import mc_util
+from mc_util import external_pb2
+
+FEE_PMOB = 400_000_000
+ACCOUNT_ID = "0" * 64
+# proposals that aren't submitted within this many blocks can't be anymore
+TOMBSTONE_BLOCKS = 10
+
+
+class JSONRPCError(Exception):
+    def __init__(self, message: str, details: str = "") -> None:
+        super().__init__(message)
+        self.message = message
+        self.details = details
+
+
+def random_hex(size: int = 32) -> str:
+    return os.urandom(size).hex()
+
+
+def random_address() -> str:
+    "A valid b58 public address, so mc_util conversions work on it"
+    address = external_pb2.PublicAddress()
+    address.view_public_key.data = os.urandom(32)
+    address.spend_public_key.data = os.urandom(32)
+    b64 = base64.b64encode(address.SerializeToString()).decode()
+    return mc_util.b64_public_address_to_b58_wrapper(b64)
+
+
+def random_receipt(value_pmob: int) -> dict:
+    "A full-service receiver receipt that survives conversion to and from protobuf"
+    return {
+        "object": "receiver_receipt",
+        "public_key": external_pb2.CompressedRistretto(data=os.urandom(32))
+        .SerializeToString()
+        .hex(),
+        "confirmation": external_pb2.TxOutConfirmationNumber(hash=os.urandom(32))
+        .SerializeToString()
+        .hex(),
+        "tombstone_block": "0",
+        "amount": {
+            "object": "amount",
+            "commitment": random_hex(),
+            "masked_value": str(value_pmob),
+        },
+    }
+
+
+class FullServiceSimulator:  # pylint: disable=too-many-instance-attributes
+    """In-memory wallet with one account. Blocks are made every block_time seconds;
+    submitted transactions settle in the next block, failing at tx_failure_rate.
+    Each request sleeps for latency (or latencies[method]) seconds, +/- jitter,
+    and fails with failure_rate (or failures[method]) probability.
+    Like full-service, input selection may pick TXOs that an unsubmitted proposal
+    already uses; with exclude_proposed, it skips them until the proposal expires."""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        balance_pmob: int = 1_000 * 10**12,
+        txo_count: int = 10,
+        block_time: float = 1.0,
+        latency: float = 0.0,
+        latencies: Optional[dict[str, float]] = None,
+        jitter: float = 0.2,
+        failure_rate: float = 0.0,
+        failures: Optional[dict[str, float]] = None,
+        tx_failure_rate: float = 0.0,
+        exclude_proposed: bool = False,
+    ) -> None:
+        self.account = {
+            "object": "account",
+            "account_id": ACCOUNT_ID,
+            "name": "bot",
+            "main_address": random_address(),
+        }
+        self.block = 3500
+        self.block_time = block_time
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failures = failures or {}
+        self.tx_failure_rate = tx_failure_rate
+        self.exclude_proposed = exclude_proposed
+        self.ids = (f"{i:064x}" for i in itertools.count(1))
+        # txo id -> {"value_pmob": int, "status": unspent|pending|spent}
+        self.txos: dict[str, dict] = {}
+        # proposal id -> {"inputs", "outputs", "change", "receipts", "block"}
+        self.proposals: dict[str, dict] = {}
+        self.logs: dict[str, dict] = {}
+        # receipt public key -> (transaction log id, value)
+        self.receipts: dict[str, tuple[Optional[str], int]] = {}
+        # calls per method, and HTTP requests (a batch is one)
+        self.requests: dict[str, int] = {}
+        self.posts = 0
+        for _ in range(txo_count):
+            self.add_txo(balance_pmob // txo_count)
+        self.methods: dict[str, Callable[..., Any]] = {
+            name.removeprefix("rpc_"): getattr(self, name)
+            for name in dir(self)
+            if name.startswith("rpc_")
+        }
+
+    def add_txo(self, value_pmob: int, status: str = "unspent") -> str:
+        txo_id = next(self.ids)
+        self.txos[txo_id] = {"value_pmob": value_pmob, "status": status}
+        return txo_id
+
+    def incoming_payment(self, value_pmob: int) -> str:
+        """Simulate someone paying the bot. Returns the b64 receipt, which resolves
+        (and credits the account) with the next block"""
+        receipt = random_receipt(value_pmob)
+        self.receipts[receipt["public_key"]] = (None, value_pmob)
+        return mc_util.full_service_receipt_to_b64_receipt(receipt)
+
+    def make_block(self) -> None:
+        "Settle every pending transaction and incoming payment"
+        self.block += 1
+        for log_id, log in self.logs.items():
+            if log["status"] != "tx_status_pending":
+                continue
+            proposal = self.proposals[log_id]
+            failed = random.random() < self.tx_failure_rate
+            for txo_id in proposal["inputs"]:
+                self.txos[txo_id]["status"] = "unspent" if failed else "spent"
+            log["status"] = "tx_status_failed" if failed else "tx_status_succeeded"
+            log["finalized_block_index"] = str(self.block)
+            if failed:
+                continue
+            for address, value in proposal["outputs"]:
+                if address == self.account["main_address"]:
+                    self.add_txo(value)
+            if proposal["change"]:
+                self.add_txo(proposal["change"])
+        for key, (source, value) in list(self.receipts.items()):
+            if source is None:
+                self.add_txo(value)
+                self.receipts[key] = ("incoming", value)
+
+    async def make_blocks(self) -> None:
+        while 1:
+            await asyncio.sleep(self.block_time)
+            self.make_block()
+
+    def unspent(self) -> list[str]:
+        return sorted(
+            (txo for txo, state in self.txos.items() if state["status"] == "unspent"),
+            key=lambda txo: self.txos[txo]["value_pmob"],
+        )
+
+    def proposed(self) -> set[str]:
+        "Inputs of proposals that could still be submitted"
+        return {
+            txo
+            for proposal_id, proposal in self.proposals.items()
+            if proposal_id not in self.logs
+            and self.block - proposal["block"] < TOMBSTONE_BLOCKS
+            for txo in proposal["inputs"]
+        }
+
+    def select_inputs(self, total_pmob: int, input_txo_ids: Optional[list]) -> list:
+        if input_txo_ids:
+            for txo in input_txo_ids:
+                if self.txos.get(txo, {}).get("status") != "unspent":
+                    raise JSONRPCError("InternalError", f"TxoNotSpendable({txo})")
+            inputs = list(input_txo_ids)
+        else:
+            inputs, found = [], 0
+            proposed = self.proposed() if self.exclude_proposed else set()
+            # largest first, like full-service's default selection
+            for txo in reversed(self.unspent()):
+                if found >= total_pmob or len(inputs) == 16:
+                    break
+                if txo in proposed:
+                    continue
+                inputs.append(txo)
+                found += self.txos[txo]["value_pmob"]
+        if sum(self.txos[txo]["value_pmob"] for txo in inputs) < total_pmob:
+            raise JSONRPCError("InternalError", "InsufficientFunds")
+        return inputs
+
+    def propose(
+        self,
+        outputs: list[tuple[str, int]],
+        fee: int = FEE_PMOB,
+        input_txo_ids: Optional[list] = None,
+    ) -> dict:
+        if len(outputs) > 15:
+            raise JSONRPCError("InvalidRequest", "TooManyOutputs")
+        total = sum(value for _, value in outputs) + fee
+        inputs = self.select_inputs(total, input_txo_ids)
+        proposal_id = next(self.ids)
+        receipts = [random_receipt(value) for _, value in outputs]
+        # like a real transaction, outputs (plus change) are in no particular order
+        tx = external_pb2.Tx()
+        tx_out_indexes = list(range(len(receipts) + 1))
+        random.shuffle(tx_out_indexes)
+        for _ in tx_out_indexes:
+            tx.prefix.outputs.add().public_key.data = os.urandom(32)
+        for outlay, receipt in enumerate(receipts):
+            output = tx.prefix.outputs[tx_out_indexes[outlay]]
+            output.public_key.ParseFromString(bytes.fromhex(receipt["public_key"]))
+        self.proposals[proposal_id] = {
+            "inputs": inputs,
+            "outputs": outputs,
+            "change": sum(self.txos[txo]["value_pmob"] for txo in inputs) - total,
+            "receipts": receipts,
+            "block": self.block,
+        }
+        return {
+            "tx_proposal": {
+                "id": proposal_id,
+                "input_list": [{"txo_id_hex": txo} for txo in inputs],
+                "outlay_list": [
+                    {"receiver": address, "value": str(value)}
+                    for address, value in outputs
+                ],
+                "fee": str(fee),
+                "tx_proto": tx.SerializeToString().hex(),
+                "outlay_index_to_tx_out_index": [
+                    [str(outlay), str(tx_out_indexes[outlay])]
+                    for outlay in range(len(receipts))
+                ],
+            },
+            "transaction_log_id": proposal_id,
+        }
+
+    async def rpc_get_all_accounts(self) -> dict:
+        return {
+            "account_ids": [ACCOUNT_ID],
+            "account_map": {ACCOUNT_ID: self.account},
+        }
+
+    async def rpc_create_account(self, name: str = "bot", **_: Any) -> dict:
+        self.account["name"] = name
+        return {"account": self.account}
+
+    async def rpc_import_account(self, name: str = "bot", **_: Any) -> dict:
+        return await self.rpc_create_account(name)
+
+    async def rpc_get_balance_for_account(self, **_: Any) -> dict:
+        unspent = sum(self.txos[txo]["value_pmob"] for txo in self.unspent())
+        return {"balance": {"unspent_pmob": str(unspent)}}
+
+    async def rpc_get_all_txos_for_account(self, **_: Any) -> dict:
+        return {
+            "txo_ids": list(self.txos),
+            "txo_map": {
+                txo: {
+                    "txo_id_hex": txo,
+                    "value_pmob": str(state["value_pmob"]),
+                    "account_status_map": {
+                        ACCOUNT_ID: {"txo_status": f"txo_status_{state['status']}"}
+                    },
+                }
+                for txo, state in self.txos.items()
+            },
+        }
+
+    async def rpc_build_transaction(
+        self,
+        recipient_public_address: str = "",
+        value_pmob: str = "0",
+        addresses_and_values: Optional[list] = None,
+        fee: Optional[str] = None,
+        input_txo_ids: Optional[list] = None,
+        **_: Any,
+    ) -> dict:
+        outputs = [
+            (address, int(value))
+            for address, value in addresses_and_values
+            or [(recipient_public_address, value_pmob)]
+        ]
+        return self.propose(outputs, int(fee or FEE_PMOB), input_txo_ids)
+
+    async def rpc_build_split_txo_transaction(
+        self, txo_id: str, output_values: list, **_: Any
+    ) -> dict:
+        address = self.account["main_address"]
+        outputs = [(address, int(value)) for value in output_values]
+        return self.propose(outputs, input_txo_ids=[txo_id])
+
+    async def rpc_submit_transaction(
+        self, tx_proposal: dict, account_id: Optional[str] = None, **_: Any
+    ) -> dict:
+        proposal_id = tx_proposal["id"]
+        proposal = self.proposals.get(proposal_id)
+        if not proposal or proposal_id in self.logs:
+            raise JSONRPCError("InternalError", "InvalidProposal")
+        for txo in proposal["inputs"]:
+            if self.txos[txo]["status"] != "unspent":
+                raise JSONRPCError("InternalError", f"TxoNotSpendable({txo})")
+        for txo in proposal["inputs"]:
+            self.txos[txo]["status"] = "pending"
+        for receipt in proposal["receipts"]:
+            value = int(receipt["amount"]["masked_value"])
+            self.receipts[receipt["public_key"]] = (proposal_id, value)
+        log = self.logs[proposal_id] = {
+            "object": "transaction_log",
+            "transaction_log_id": proposal_id,
+            "account_id": ACCOUNT_ID,
+            "direction": "tx_direction_sent",
+            "status": "tx_status_pending",
+            "value_pmob": str(sum(value for _, value in proposal["outputs"])),
+            "submitted_block_index": str(self.block),
+            "finalized_block_index": None,
+        }
+        # like full-service, only transactions submitted with an account are logged
+        return {"transaction_log": log if account_id else None}
+
+    async def rpc_get_transaction_log(self, transaction_log_id: str) -> dict:
+        if transaction_log_id not in self.logs:
+            raise JSONRPCError("InternalError", "TransactionLogNotFound")
+        return {"transaction_log": self.logs[transaction_log_id]}
+
+    async def rpc_get_all_transaction_logs_for_account(self, **_: Any) -> dict:
+        return {
+            "transaction_log_ids": list(self.logs),
+            "transaction_log_map": self.logs,
+        }
+
+    async def rpc_get_all_transaction_logs_for_block(self, block_index: str) -> dict:
+        logs = {
+            log_id: log
+            for log_id, log in self.logs.items()
+            if log["finalized_block_index"] == block_index
+        }
+        return {"transaction_log_ids": list(logs), "transaction_log_map": logs}
+
+    async def rpc_get_account_status(self, **_: Any) -> dict:
+        return {
+            "account": self.account | {"next_block_index": str(self.block + 1)},
+            "network_block_height": str(self.block + 1),
+            "local_block_height": str(self.block + 1),
+        }
+
+    async def rpc_get_all_transaction_logs_ordered_by_block(self, **_: Any) -> dict:
+        return await self.rpc_get_all_transaction_logs_for_account()
+
+    async def rpc_create_receiver_receipts(self, tx_proposal: dict, **_: Any) -> dict:
+        proposal = self.proposals.get(tx_proposal["id"])
+        if not proposal:
+            raise JSONRPCError("InternalError", "InvalidProposal")
+        return {"receiver_receipts": proposal["receipts"]}
+
+    async def rpc_check_receiver_receipt_status(
+        self, receiver_receipt: dict, **_: Any
+    ) -> dict:
+        log_id, value = self.receipts.get(
+            receiver_receipt["public_key"], ("missing", 0)
+        )
+        if log_id == "missing":
+            raise JSONRPCError("InternalError", "ReceiptNotFound")
+        settled = log_id == "incoming" or (
+            log_id in self.logs and self.logs[log_id]["status"] == "tx_status_succeeded"
+        )
+        if not settled:
+            return {"receipt_transaction_status": "TransactionPending", "txo": None}
+        return {
+            "receipt_transaction_status": "TransactionSuccess",
+            "txo": {"value_pmob": str(value)},
+        }
+
+    async def rpc_build_gift_code(
+        self, value_pmob: str, fee: Optional[str] = None, **_: Any
+    ) -> dict:
+        # the gift code holds the value until it's claimed, so it's paid to nobody here
+        proposal = self.propose([("gift code", int(value_pmob))], int(fee or FEE_PMOB))
+        return proposal | {"gift_code_b58": random_hex(48)}
+
+    async def rpc_submit_gift_code(
+        self, tx_proposal: dict, gift_code_b58: str, **_: Any
+    ) -> dict:
+        submitted = await self.rpc_submit_transaction(tx_proposal, ACCOUNT_ID)
+        return {
+            "gift_code": {
+                "object": "gift_code",
+                "gift_code_b58": gift_code_b58,
+                "value_pmob": submitted["transaction_log"]["value_pmob"],
+            }
+        }
+
+    async def rpc_get_block(self, block_index: str = "0", **_: Any) -> dict:
+        return {
+            "block": {"index": block_index},
+            "network_status": {"local_block_height": str(self.block)},
+        }
+
+    async def call(self, request: dict) -> dict:
+        method = request.get("method", "")
+        response: dict = {"jsonrpc": "2.0", "id": request.get("id"), "method": method}
+        self.requests[method] = self.requests.get(method, 0) + 1
+        latency = self.latencies.get(method, self.latency)
+        if latency:
+            await asyncio.sleep(
+                latency * random.uniform(1 - self.jitter, 1 + self.jitter)
+            )
+        try:
+            if method not in self.methods:
+                raise JSONRPCError("MethodNotFound", method)
+            if random.random() < self.failures.get(method, self.failure_rate):
+                raise JSONRPCError("InternalError", "injected failure")
+            response["result"] = await self.methods[method](**request.get("params", {}))
+        except JSONRPCError as e:
+            response["error"] = {
+                "code": -32603,
+                "message": e.message,
+                "data": {"server_error": e.details, "details": e.details},
+            }
+        except TypeError as e:
+            response["error"] = {"code": -32602, "message": "InvalidParams: " + str(e)}
+        return response
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.posts += 1
+        body = await request.json()
+        if isinstance(body, list):
+            return web.json_response(await asyncio.gather(*map(self.call, body)))
+        return web.json_response(await self.call(body))
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([web.post("/wallet", self.handle)])
+
+        async def start_blocks(app: web.Application) -> None:
+            app["blocks"] = asyncio.create_task(self.make_blocks())
+
+        async def stop_blocks(app: web.Application) -> None:
+            app["blocks"].cancel()
+
+        app.on_startup.append(start_blocks)
+        app.on_cleanup.append(stop_blocks)
+        return app
+
+    async def start(self, port: int = 9090, host: str = "127.0.0.1") -> web.AppRunner:
+        "Serve in the running loop; call .cleanup() on the result to stop"
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info("simulated full-service on http://%s:%s/wallet", host, port)
+        return runner
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--balance-mob", type=float, default=1000)
+    parser.add_argument("--txos", type=int, default=10)
+    parser.add_argument("--block-time", type=float, default=1.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--tx-failure-rate", type=float, default=0.0)
+    parser.add_argument("--exclude-proposed", action="store_true")
+    args = parser.parse_args()
+    simulator = FullServiceSimulator(
+        balance_pmob=int(args.balance_mob * 10**12),
+        txo_count=args.txos,
+        block_time=args.block_time,
+        latency=args.latency,
+        failure_rate=args.failure_rate,
+        tx_failure_rate=args.tx_failure_rate,
+        exclude_proposed=args.exclude_proposed,
+    )
+    web.run_app(simulator.app(), port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@
 
 import asyncio
 import base64
+import itertools
 import json
 import logging
 import random
@@ -13,9 +14,10 @@ import time
 from typing import Any, Optional
 import aiohttp
 import asyncpg
+from prometheus_client import Counter, Gauge, Histogram
 
 import mc_util
-from forest import utils
+from forest import rates, utils
 from forest.pghelp import Loop, PGExpressions, PGInterface
 
 if not utils.get_secret("ROOTCRT"):
@@ -36,7 +38,70 @@ else:
 MICROMOB_TO_PICOMOB = 1_000_000
 MILLIMOB_TO_PICOMOB = 1_000_000_000
 
+FULL_SERVICE_TIMEOUT = float(utils.get_secret("FULL_SERVICE_TIMEOUT") or 60)
+FULL_SERVICE_RETRIES = int(utils.get_secret("FULL_SERVICE_RETRIES") or 3)
+FULL_SERVICE_CONNECTIONS = int(utils.get_secret("FULL_SERVICE_CONNECTIONS") or 16)
+# methods that only read or derive state, so they can be retried after a timeout
+# or server error without risking a duplicate side effect
+RETRYABLE_PREFIXES = ("get_", "check_", "verify_", "create_receiver_receipts")
+# concurrent read-only calls made within this many seconds share one JSON-RPC batch
+FULL_SERVICE_BATCH_WINDOW = float(
+    utils.get_secret("FULL_SERVICE_BATCH_WINDOW") or 0.005
+)
+FULL_SERVICE_BATCH_SIZE = int(utils.get_secret("FULL_SERVICE_BATCH_SIZE") or 64)
+
+full_service_latency = Histogram(
+    "full_service_request_seconds", "full-service request latency", ["method"]
+)
+full_service_failures = Counter(
+    "full_service_failures", "Failed full-service requests", ["method", "reason"]
+)
+full_service_batch_size = Histogram(
+    "full_service_batch_size",
+    "Requests per full-service JSON-RPC batch",
+    buckets=[1, 2, 4, 8, 16, 32, 64, 128],
+)
+
+pending_transactions = Gauge(
+    "full_service_pending_transactions", "Transactions awaiting confirmation"
+)
+# how long an incoming payment's receipt is polled before giving up on it
+RECEIPT_TIMEOUT = float(utils.get_secret("RECEIPT_TIMEOUT") or 600)
+# accounts rarely change outside of the calls that invalidate the cache
+ACCOUNT_CACHE_TTL = float(utils.get_secret("ACCOUNT_CACHE_TTL") or 3600)
+ACCOUNT_MUTATIONS = (
+    "import_account",
+    "create_account",
+    "remove_account",
+    "update_account_name",
+)
+receipt_confirm_time = Histogram(
+    "receipt_confirm_seconds",
+    "Time for incoming payment receipts to resolve",
+    ["outcome"],
+    buckets=[1, 2, 5, 10, 20, 30, 60, 120, 300, 600],
+)
+pending_receipts = Gauge("pending_receipts", "Incoming payment receipts being polled")
+
 DATABASE_URL = utils.get_secret("DATABASE_URL")
+# folds the row inserted by the `tx` CTE into the account's materialized balance,
+# so the ledger and balances are updated by a single atomic statement
+UPSERT_BALANCE = (
+    "INSERT INTO {self.table}_balances (account, usd_cents, pmob, updated) \
+        SELECT account, amount_usd_cents, COALESCE(amount_pmob, 0), CURRENT_TIMESTAMP \
+        FROM tx WHERE account IS NOT NULL \
+        ON CONFLICT (account) DO UPDATE SET \
+        usd_cents = {self.table}_balances.usd_cents + EXCLUDED.usd_cents, \
+        pmob = {self.table}_balances.pmob + EXCLUDED.pmob, \
+        updated = EXCLUDED.updated;"
+)
+REBUILD_BALANCES = (
+    "INSERT INTO {self.table}_balances (account, usd_cents, pmob, updated) \
+        SELECT account, COALESCE(SUM(amount_usd_cents), 0), COALESCE(SUM(amount_pmob), 0), \
+        CURRENT_TIMESTAMP FROM {self.table} WHERE account IS NOT NULL GROUP BY account \
+        ON CONFLICT (account) DO UPDATE SET usd_cents = EXCLUDED.usd_cents, \
+        pmob = EXCLUDED.pmob, updated = EXCLUDED.updated;"
+)
 LedgerPGExpressions = PGExpressions(
     table=utils.get_secret("LEDGER_NAME") or "ledger",
     create_table="""CREATE TABLE IF NOT EXISTS {self.table} (
@@ -46,14 +111,45 @@ LedgerPGExpressions = PGExpressions(
         amount_pmob BIGINT,
         memo TEXT,
         ts TIMESTAMP);""",
-    put_usd_tx="INSERT INTO {self.table} (account, amount_usd_cents, memo, ts) \
-        VALUES($1, $2, $3, CURRENT_TIMESTAMP);",
-    put_pmob_tx="INSERT INTO {self.table} (account, amount_usd_cents, amount_pmob, memo, ts) \
-        VALUES($1, $2, $3, $4, CURRENT_TIMESTAMP);",
-    get_usd_balance="SELECT COALESCE(SUM(amount_usd_cents)/100, 0.0) AS balance \
-        FROM {self.table} WHERE account=$1",
-    get_pmob_balance="SELECT COALESCE(SUM(amount_pmob), 0.0) AS balance \
-        FROM {self.table} WHERE account=$1",
+    create_balances_table="""CREATE TABLE IF NOT EXISTS {self.table}_balances (
+        account TEXT PRIMARY KEY,
+        usd_cents NUMERIC NOT NULL DEFAULT 0,
+        pmob NUMERIC NOT NULL DEFAULT 0,
+        updated TIMESTAMP);""",
+    put_usd_tx="WITH tx AS (INSERT INTO {self.table} (account, amount_usd_cents, memo, ts) \
+        VALUES($1, $2, $3, CURRENT_TIMESTAMP) \
+        RETURNING account, amount_usd_cents, amount_pmob) "
+    + UPSERT_BALANCE,
+    put_pmob_tx="WITH tx AS (INSERT INTO {self.table} (account, amount_usd_cents, amount_pmob, memo, ts) \
+        VALUES($1, $2, $3, $4, CURRENT_TIMESTAMP) \
+        RETURNING account, amount_usd_cents, amount_pmob) "
+    + UPSERT_BALANCE,
+    get_usd_balance="SELECT COALESCE((SELECT usd_cents FROM {self.table}_balances \
+        WHERE account=$1)/100, 0.0) AS balance",
+    get_pmob_balance="SELECT COALESCE((SELECT pmob FROM {self.table}_balances \
+        WHERE account=$1), 0.0) AS balance",
+    # recomputes every materialized balance from the raw ledger
+    rebuild_balances=REBUILD_BALANCES,
+    # backfills balances once for ledgers that predate them
+    migrate_balances=REBUILD_BALANCES,
+    # blocks balance updates, but not reads, until the transaction ends
+    lock_balances="LOCK TABLE {self.table}_balances IN SHARE ROW EXCLUSIVE MODE;",
+    # drops balances for accounts that no longer have any ledger rows
+    delete_orphan_balances="DELETE FROM {self.table}_balances AS balances \
+        WHERE NOT EXISTS (SELECT 1 FROM {self.table} WHERE account = balances.account);",
+    # lists accounts whose materialized balance disagrees with the raw ledger
+    reconcile_balances="SELECT COALESCE(ledger.account, balances.account) AS account, \
+        COALESCE(ledger.usd_cents, 0) AS ledger_usd_cents, \
+        COALESCE(balances.usd_cents, 0) AS balance_usd_cents, \
+        COALESCE(ledger.pmob, 0) AS ledger_pmob, \
+        COALESCE(balances.pmob, 0) AS balance_pmob \
+        FROM (SELECT account, COALESCE(SUM(amount_usd_cents), 0) AS usd_cents, \
+            COALESCE(SUM(amount_pmob), 0) AS pmob \
+            FROM {self.table} WHERE account IS NOT NULL GROUP BY account) AS ledger \
+        FULL OUTER JOIN {self.table}_balances AS balances \
+        ON ledger.account = balances.account \
+        WHERE COALESCE(ledger.usd_cents, 0) <> COALESCE(balances.usd_cents, 0) \
+        OR COALESCE(ledger.pmob, 0) <> COALESCE(balances.pmob, 0);",
 )
 
 InvoicePGEExpressions = PGExpressions(
@@ -63,10 +159,446 @@ InvoicePGEExpressions = PGExpressions(
         account CHARACTER VARYING(16), \
         unique_pmob BIGINT, \
         memo CHARACTER VARYING(32), \
+        created TIMESTAMP DEFAULT now(), \
         unique(unique_pmob))",
-    create_invoice="INSERT INTO {self.table} (account, unique_pmob, memo) VALUES($1, $2, $3)",
+    migrate_invoice_created="ALTER TABLE {self.table} \
+        ADD COLUMN IF NOT EXISTS created TIMESTAMP DEFAULT now()",
+    create_invoice="INSERT INTO {self.table} (account, unique_pmob, memo) VALUES($1, $2, $3) \
+        RETURNING invoice_id, account, unique_pmob, memo",
     get_invoice_by_amount="SELECT invoice_id, account FROM {self.table} WHERE unique_pmob=$1",
+    get_open_invoices="SELECT invoice_id, account, unique_pmob, memo, \
+        EXTRACT(EPOCH FROM now() - created) AS age FROM {self.table} \
+        WHERE created >= now() - $1::FLOAT * INTERVAL '1 second'",
+    expire_invoices="DELETE FROM {self.table} \
+        WHERE created < now() - $1::FLOAT * INTERVAL '1 second'",
+)
+TransactionLogPGExpressions = PGExpressions(
+    table="transaction_logs",
+    create_table="CREATE TABLE IF NOT EXISTS {self.table} (\
+        transaction_log_id TEXT PRIMARY KEY, \
+        account_id TEXT, \
+        direction TEXT, \
+        status TEXT, \
+        submitted_block BIGINT, \
+        finalized_block BIGINT, \
+        log JSONB, \
+        updated TIMESTAMP DEFAULT now());",
+    create_status_index="CREATE INDEX IF NOT EXISTS {self.table}_status \
+        ON {self.table} (account_id, status, submitted_block)",
+    create_block_index="CREATE INDEX IF NOT EXISTS {self.table}_block \
+        ON {self.table} (account_id, finalized_block, submitted_block)",
+    create_sync_table="CREATE TABLE IF NOT EXISTS {self.table}_sync (\
+        account_id TEXT PRIMARY KEY, \
+        synced_block BIGINT, \
+        updated TIMESTAMP DEFAULT now());",
+    # $2 is a JSON array of full-service transaction logs
+    put_logs="INSERT INTO {self.table} (transaction_log_id, account_id, direction, \
+        status, submitted_block, finalized_block, log, updated) \
+        SELECT log->>'transaction_log_id', $1, log->>'direction', log->>'status', \
+        NULLIF(log->>'submitted_block_index', '')::BIGINT, \
+        NULLIF(log->>'finalized_block_index', '')::BIGINT, log, now() \
+        FROM jsonb_array_elements($2::JSONB) AS log \
+        ON CONFLICT (transaction_log_id) DO UPDATE SET status=EXCLUDED.status, \
+        submitted_block=EXCLUDED.submitted_block, finalized_block=EXCLUDED.finalized_block, \
+        log=EXCLUDED.log, updated=now()",
+    get_logs="SELECT log FROM {self.table} WHERE account_id=$1 \
+        ORDER BY finalized_block NULLS LAST, submitted_block",
+    get_pending_logs="SELECT log FROM {self.table} WHERE account_id=$1 \
+        AND status='tx_status_pending' AND submitted_block >= $2",
+    get_synced_block="SELECT synced_block FROM {self.table}_sync WHERE account_id=$1",
+    set_synced_block="INSERT INTO {self.table}_sync (account_id, synced_block, updated) \
+        VALUES ($1, $2, now()) ON CONFLICT (account_id) \
+        DO UPDATE SET synced_block=$2, updated=now()",
+)
+# the mirror catches up every this many seconds
+TRANSACTION_LOG_SYNC_INTERVAL = float(
+    utils.get_secret("TRANSACTION_LOG_SYNC_INTERVAL") or 10
 )
+# past this many unsynced blocks, one full download is cheaper than a call per block
+TRANSACTION_LOG_MAX_BLOCK_GAP = 200
+mirrored_block = Gauge(
+    "transaction_log_mirror_block", "Last block the transaction log mirror synced"
+)
+# invoices that haven't been paid in this long free up their amount
+INVOICE_TTL = float(utils.get_secret("INVOICE_TTL") or 86400)
+# invoice amounts are perturbed in steps of 1e-8 MOB, up to INVOICE_POOL_SIZE steps
+INVOICE_STEP_PMOB = 10_000
+INVOICE_POOL_SIZE = 10_000
+
+
+class TransientFullServiceError(Exception):
+    pass
+
+
+class FullServiceClient:
+    """Long-lived JSON-RPC client for a full-service instance.
+    Reuses keep-alive connections, times requests out instead of hanging,
+    and retries transient failures with jittered exponential backoff.
+    Requests that can't connect are always retried; requests that may have reached
+    full-service are only retried for read-only methods.
+    Concurrent read-only requests are gathered into JSON-RPC batches, falling back
+    to single requests for anything a batch didn't answer. Batching is turned off if
+    the server rejects batches, and paused with backoff if batches fail in transit."""
+
+    def __init__(
+        self,
+        url: str,
+        timeout: float = FULL_SERVICE_TIMEOUT,
+        retries: int = FULL_SERVICE_RETRIES,
+        batch_window: float = FULL_SERVICE_BATCH_WINDOW,
+    ) -> None:
+        self.url = url
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=min(timeout, 10))
+        self.retries = retries
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.ids = itertools.count(1)
+        # disabled for good if the server turns out not to understand batches
+        self.batching = batch_window > 0
+        self.batch_window = batch_window
+        # consecutive batches that failed in transit, and when to try batching again
+        self.batch_failures = 0
+        self.batch_paused_until = 0.0
+        self.pending: list[tuple[dict, asyncio.Future]] = []
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.batch_tasks: set[asyncio.Task] = set()
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # created lazily so that it belongs to the running loop
+        if not self.session or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                ssl=ssl_context or True, limit=FULL_SERVICE_CONNECTIONS
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout
+            )
+        return self.session
+
+    async def post(self, body: Any) -> Any:
+        async with self.get_session().post(
+            self.url,
+            data=json.dumps(body),
+            headers={"Content-Type": "application/json"},
+        ) as resp:
+            if resp.status >= 500:
+                raise TransientFullServiceError(f"HTTP {resp.status}")
+            return await resp.json(content_type=None)
+
+    async def request(self, data: dict) -> dict:
+        # only read-only calls are batched, so falling back to single requests
+        # after a failed batch never repeats a side effect
+        if (
+            self.batching
+            and time.time() >= self.batch_paused_until
+            and data.get("method", "").startswith(RETRYABLE_PREFIXES)
+        ):
+            future = asyncio.get_running_loop().create_future()
+            self.pending.append((data, future))
+            self.schedule_flush()
+            return await future
+        return await self.send(data)
+
+    def schedule_flush(self) -> None:
+        if len(self.pending) >= FULL_SERVICE_BATCH_SIZE:
+            self.flush()
+        elif not self.flush_handle:
+            self.flush_handle = asyncio.get_running_loop().call_later(
+                self.batch_window, self.flush
+            )
+
+    def flush(self) -> None:
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self.send_batch(batch))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
+
+    async def send_batch(self, batch: list[tuple[dict, asyncio.Future]]) -> None:
+        """Sends a JSON-RPC batch and resolves each caller's future with its response"""
+        requests = {next(self.ids): (data, future) for data, future in batch}
+        try:
+            if len(requests) > 1:
+                await self.post_batch(requests)
+            # anything the batch didn't answer is sent on its own
+            unanswered = [
+                (data, future)
+                for data, future in requests.values()
+                if not future.done()
+            ]
+            results = await asyncio.gather(*(self.send(data) for data, _ in unanswered))
+            for (_, future), result in zip(unanswered, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:  # pylint: disable=broad-except
+            # never leave callers waiting forever
+            for _, future in requests.values():
+                if not future.done():
+                    future.set_exception(e)
+
+    async def post_batch(
+        self, requests: dict[int, tuple[dict, asyncio.Future]]
+    ) -> None:
+        body = [
+            {"jsonrpc": "2.0", "id": request_id, **data}
+            for request_id, (data, _) in requests.items()
+        ]
+        full_service_batch_size.observe(len(body))
+        start_time = time.time()
+        try:
+            responses = await self.post(body)
+        except ValueError as e:
+            # a 4xx with an error page rather than JSON-RPC, say
+            full_service_failures.labels("batch", type(e).__name__).inc()
+            logging.warning("full-service can't parse batches (%s), disabling", e)
+            self.batching = False
+            return
+        except (
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+            TransientFullServiceError,
+        ) as e:
+            full_service_failures.labels("batch", type(e).__name__).inc()
+            self.batch_failures += 1
+            pause = min(2**self.batch_failures, 60)
+            self.batch_paused_until = time.time() + pause
+            logging.warning(
+                "full-service batch failed (%s), sending singly for %ss", e, pause
+            )
+            return
+        if not isinstance(responses, list):
+            logging.warning("full-service rejected a batch (%s), disabling", responses)
+            self.batching = False
+            return
+        self.batch_failures = 0
+        elapsed = time.time() - start_time
+        for response in responses:
+            data, future = requests.get(response.get("id"), ({}, None))
+            if future and not future.done():
+                full_service_latency.labels(data.get("method", "")).observe(elapsed)
+                future.set_result({"method": data.get("method"), **response})
+
+    async def send(self, data: dict) -> dict:
+        method = data.get("method", "")
+        body = {"jsonrpc": "2.0", "id": next(self.ids), **data}
+        retryable = method.startswith(RETRYABLE_PREFIXES)
+        error: Exception = TransientFullServiceError("no attempts made")
+        for attempt in range(self.retries + 1):
+            start_time = time.time()
+            try:
+                result = await self.post(body)
+                full_service_latency.labels(method).observe(time.time() - start_time)
+                return result
+            except aiohttp.ClientConnectorError as e:
+                # never reached full-service, so this is safe to retry for any method
+                reason, error, may_retry = "connect", e, True
+            except (
+                aiohttp.ClientError,
+                asyncio.TimeoutError,
+                TransientFullServiceError,
+            ) as e:
+                reason, error, may_retry = type(e).__name__, e, retryable
+            full_service_failures.labels(method, reason).inc()
+            if not may_retry or attempt >= self.retries:
+                break
+            backoff = min(0.25 * 2**attempt, 8) * random.uniform(0.5, 1.5)
+            logging.warning(
+                "full-service %s failed (%s), retrying in %.2fs", method, error, backoff
+            )
+            await asyncio.sleep(backoff)
+        logging.error("full-service %s failed: %s", method, repr(error))
+        return {
+            "jsonrpc": "2.0",
+            "id": body["id"],
+            "method": method,
+            "error": {"code": -32000, "message": f"RequestFailed: {error!r}"},
+        }
+
+    async def close(self) -> None:
+        self.flush()
+        if self.batch_tasks:
+            await asyncio.wait(self.batch_tasks)
+        if self.session:
+            await self.session.close()
+
+
+full_service_clients: dict[str, FullServiceClient] = {}
+
+
+def get_full_service_client(url: str) -> FullServiceClient:
+    """Every Mobster talking to the same url shares one client and connection pool"""
+    if url not in full_service_clients:
+        full_service_clients[url] = FullServiceClient(url)
+    return full_service_clients[url]
+
+
+async def close_full_service_clients() -> None:
+    for client in full_service_clients.values():
+        await client.close()
+
+
+class TransactionWatcher:
+    """Waits for submitted transactions to settle.
+    A single background task polls every pending transaction log once per tick.
+    The lookups go out concurrently, so with batching full-service sees one request
+    per FULL_SERVICE_BATCH_SIZE (64 by default) payments in flight each tick.
+    With batching disabled, it's one request per payment each tick."""
+
+    settled = ("tx_status_succeeded", "tx_status_failed")
+
+    def __init__(self, mobster: "Mobster", interval: float = 1.0) -> None:
+        self.mobster = mobster
+        self.interval = interval
+        self.pending: dict[str, asyncio.Future] = {}
+        self.waiters: dict[str, int] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    async def wait(self, tx_id: str, timeout: float) -> dict:
+        """Returns the transaction log once it succeeds or fails.
+        If it's still pending after timeout seconds, returns a stand-in log
+        with just its id and a pending status."""
+        future = self.pending.get(tx_id)
+        if not future:
+            future = self.pending[tx_id] = asyncio.get_running_loop().create_future()
+            pending_transactions.set(len(self.pending))
+        self.waiters[tx_id] = self.waiters.get(tx_id, 0) + 1
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.watch())
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return {"transaction_log_id": tx_id, "status": "tx_status_pending"}
+        finally:
+            self.waiters[tx_id] -= 1
+            if not self.waiters[tx_id]:
+                self.waiters.pop(tx_id)
+                self.pending.pop(tx_id, None)
+                pending_transactions.set(len(self.pending))
+
+    async def poll(self) -> None:
+        tx_ids = list(self.pending)
+        results = await asyncio.gather(
+            *(
+                self.mobster.req_("get_transaction_log", transaction_log_id=tx_id)
+                for tx_id in tx_ids
+            ),
+            return_exceptions=True,
+        )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        for tx_id, result in zip(tx_ids, results):
+            if isinstance(result, BaseException):
+                continue
+            log = result.get("result", {}).get("transaction_log", {})
+            future = self.pending.get(tx_id)
+            if future and not future.done() and log.get("status") in self.settled:
+                future.set_result(log)
+        if errors:
+            raise errors[0]
+
+    async def watch(self) -> None:
+        delay = self.interval
+        while self.pending:
+            await asyncio.sleep(delay)
+            try:
+                await self.poll()
+                delay = self.interval
+            except Exception:  # pylint: disable=broad-except
+                # keep going, or every waiter would sit out its whole timeout
+                logging.exception("couldn't check pending transactions")
+                delay = min(delay * 2, 30)
+
+
+class ReceiptResolver:
+    """Resolves incoming payment receipts to the amount received.
+    Pending receipts are queued and polled together by one background task,
+    each with exponential backoff up to max_delay, and given up on after a deadline."""
+
+    def __init__(
+        self,
+        mobster: "Mobster",
+        timeout: float = RECEIPT_TIMEOUT,
+        initial_delay: float = 1.0,
+        max_delay: float = 30.0,
+    ) -> None:
+        self.mobster = mobster
+        self.timeout = timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        # receipt -> (future, started, deadline, delay, next check)
+        self.pending: dict[str, tuple[asyncio.Future, float, float, float, float]] = {}
+        self.task: Optional[asyncio.Task] = None
+        # set when a receipt is queued, so it's checked without waiting out the sleep
+        self.queued = asyncio.Event()
+
+    async def resolve(self, receipt_str: str) -> Optional[int]:
+        """Returns the pmob received, or None if the receipt is invalid or didn't
+        resolve before the deadline"""
+        if receipt_str not in self.pending:
+            now = time.time()
+            future = asyncio.get_running_loop().create_future()
+            self.pending[receipt_str] = (future, now, now + self.timeout, 0.0, now)
+            pending_receipts.set(len(self.pending))
+            self.queued.set()
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.watch())
+        return await asyncio.shield(self.pending[receipt_str][0])
+
+    def finish(self, receipt_str: str, amount: Optional[int], outcome: str) -> None:
+        future, started, *_ = self.pending.pop(receipt_str)
+        pending_receipts.set(len(self.pending))
+        receipt_confirm_time.labels(outcome).observe(time.time() - started)
+        if not future.done():
+            future.set_result(amount)
+
+    async def check(self, receipt_str: str) -> None:
+        address = await self.mobster.get_my_address()
+        full_service_receipt = mc_util.b64_receipt_to_full_service_receipt(receipt_str)
+        tx = await self.mobster.req_(
+            "check_receiver_receipt_status",
+            address=address,
+            receiver_receipt=full_service_receipt,
+        )
+        # {'method': 'check_receiver_receipt_status', 'result':
+        # {'receipt_transaction_status': 'TransactionPending', 'txo': None}, 'jsonrpc': '2.0', 'id': 1}
+        if "error" in tx:
+            self.finish(receipt_str, None, "error")
+            return
+        if tx["result"]["receipt_transaction_status"] != "TransactionPending":
+            self.finish(receipt_str, int(tx["result"]["txo"]["value_pmob"]), "received")
+            return
+        future, started, deadline, delay, _ = self.pending[receipt_str]
+        now = time.time()
+        if now >= deadline:
+            logging.warning("receipt still pending after %ss, giving up", self.timeout)
+            self.finish(receipt_str, None, "timeout")
+            return
+        delay = min(max(delay * 2, self.initial_delay), self.max_delay)
+        self.pending[receipt_str] = (future, started, deadline, delay, now + delay)
+
+    async def watch(self) -> None:
+        while self.pending:
+            next_check = min(entry[4] for entry in self.pending.values())
+            self.queued.clear()
+            try:
+                await asyncio.wait_for(
+                    self.queued.wait(), max(next_check - time.time(), 0)
+                )
+            except asyncio.TimeoutError:
+                pass
+            due = [
+                receipt_str
+                for receipt_str, entry in self.pending.items()
+                if entry[4] <= time.time()
+            ]
+            results = await asyncio.gather(
+                *map(self.check, due), return_exceptions=True
+            )
+            for receipt_str, result in zip(due, results):
+                if isinstance(result, Exception):
+                    logging.error("couldn't check receipt: %s", repr(result))
+                    if receipt_str in self.pending:
+                        self.finish(receipt_str, None, "error")
 
 
 class InvoiceManager(PGInterface):
@@ -74,6 +606,245 @@ class InvoiceManager(PGInterface):
         super().__init__(InvoicePGEExpressions, DATABASE_URL, None)
 
 
+class InvoiceAllocator:
+    """Hands out unique invoice amounts and matches payments back to invoices.
+    Open invoices are indexed by amount in memory, so picking a free amount and
+    looking one up don't need a database round trip. Each invoice pays the MOB
+    price plus a distinct multiple of INVOICE_STEP_PMOB."""
+
+    def __init__(self, manager: InvoiceManager) -> None:
+        self.manager = manager
+        # unique_pmob -> invoice record
+        self.by_amount: dict[int, dict] = {}
+        # unique_pmob -> when we found it taken by another node, kept apart from
+        # by_amount because we don't have those invoices' records
+        self.taken: dict[int, float] = {}
+        self.offset = random.randrange(1, INVOICE_POOL_SIZE)
+        self.loaded = False
+        self.expired = 0.0
+        self.lock = asyncio.Lock()
+
+    async def load(self) -> None:
+        "Index invoices that are still open, e.g. made by a previous run or another node"
+        now = time.time()
+        for record in await self.manager.get_open_invoices(INVOICE_TTL) or []:
+            invoice = dict(record)
+            invoice["created"] = now - float(invoice.pop("age"))
+            self.by_amount[invoice["unique_pmob"]] = invoice
+        self.loaded = True
+
+    async def expire(self) -> None:
+        "Drop invoices older than INVOICE_TTL so their amounts can be reused"
+        now = time.time()
+        if now - self.expired < min(INVOICE_TTL / 10, 600):
+            return
+        self.expired = now
+        await self.manager.expire_invoices(INVOICE_TTL)
+        self.by_amount = {
+            pmob: invoice
+            for pmob, invoice in self.by_amount.items()
+            if invoice["created"] >= now - INVOICE_TTL
+        }
+        self.taken = {
+            pmob: created
+            for pmob, created in self.taken.items()
+            if created >= now - INVOICE_TTL
+        }
+
+    def free_amount(self, base_pmob: int) -> int:
+        "Next perturbed amount for base_pmob that isn't taken by an open invoice"
+        for _ in range(INVOICE_POOL_SIZE):
+            self.offset = self.offset % (INVOICE_POOL_SIZE - 1) + 1
+            amount = base_pmob + self.offset * INVOICE_STEP_PMOB
+            if amount not in self.by_amount and amount not in self.taken:
+                return amount
+        raise ValueError(f"no free invoice amounts near {base_pmob}pmob")
+
+    async def allocate(self, base_pmob: int, account: str, memo: str) -> int:
+        "Creates an invoice for about base_pmob and returns its unique amount in pmob"
+        async with self.lock:
+            if not self.loaded:
+                await self.load()
+            await self.expire()
+            # only another node taking the same amount at the same time can collide
+            for _ in range(3):
+                amount = self.free_amount(base_pmob)
+                try:
+                    records = await self.manager.create_invoice(account, amount, memo)
+                except asyncpg.UniqueViolationError:
+                    self.taken[amount] = time.time()
+                    continue
+                if not records:
+                    self.taken[amount] = time.time()
+                    return amount
+                invoice = dict(records[0])
+                self.by_amount[amount] = {**invoice, "created": time.time()}
+                return amount
+            raise ValueError("couldn't allocate a unique invoice amount")
+
+    async def lookup(self, amount_pmob: int) -> Optional[dict]:
+        "Returns the open invoice with this exact amount, if any"
+        invoice = self.by_amount.get(amount_pmob)
+        if invoice and invoice.get("invoice_id") is not None:
+            return invoice
+        # not made by this node since it last loaded, or taken by another node
+        records = await self.manager.get_invoice_by_amount(amount_pmob)
+        return dict(records[0]) if records else None
+
+
+class TransactionLogMirror:
+    """Copy of the account's full-service transaction logs in postgres.
+    The first sync downloads every log, then a background task asks full-service only
+    for logs finalized in blocks it hasn't seen yet, plus re-checks logs still pending.
+    Without a database, queries go straight to full-service."""
+
+    def __init__(
+        self,
+        mobster: "Mobster",
+        database: str = DATABASE_URL,
+        interval: float = TRANSACTION_LOG_SYNC_INTERVAL,
+    ) -> None:
+        self.mobster = mobster
+        self.interface = (
+            PGInterface(TransactionLogPGExpressions, database) if database else None
+        )
+        self.interval = interval
+        self.synced_block: Optional[int] = None
+        # the sync in progress, which concurrent callers wait on rather than repeat
+        self.sync_task: Optional[asyncio.Task] = None
+        self.failed_at = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    async def fetch_all(self, account_id: str) -> dict[str, dict]:
+        return (
+            await self.mobster.req_(
+                "get_all_transaction_logs_for_account", account_id=account_id
+            )
+        )["result"]["transaction_log_map"]
+
+    async def fetch_blocks(self, account_id: str, start: int, end: int) -> dict:
+        "Logs finalized in blocks start..end inclusive, and updates to pending logs"
+        results = await asyncio.gather(
+            *(
+                self.mobster.req_(
+                    "get_all_transaction_logs_for_block", block_index=str(block)
+                )
+                for block in range(start, end + 1)
+            )
+        )
+        logs = {
+            log_id: log
+            for result in results
+            for log_id, log in result["result"]["transaction_log_map"].items()
+            if log.get("account_id", account_id) == account_id
+        }
+        assert self.interface
+        pending = [
+            json.loads(record.get("log"))
+            for record in await self.interface.get_pending_logs(account_id, 0) or []
+        ]
+        updates = await asyncio.gather(
+            *(
+                self.mobster.req_(
+                    "get_transaction_log",
+                    transaction_log_id=log["transaction_log_id"],
+                )
+                for log in pending
+                if log["transaction_log_id"] not in logs
+            )
+        )
+        for update in updates:
+            log = update.get("result", {}).get("transaction_log")
+            if log:
+                logs[log["transaction_log_id"]] = log
+        return logs
+
+    async def sync(self) -> None:
+        "Bring the mirror up to the last block full-service has scanned for the account"
+        if not self.interface:
+            return
+        if not self.sync_task or self.sync_task.done():
+            self.sync_task = asyncio.create_task(self.sync_once())
+        # shielded so that one caller giving up doesn't cancel it for the others
+        try:
+            await asyncio.shield(self.sync_task)
+        except (KeyError, TypeError, ValueError, OSError, asyncpg.PostgresError):
+            self.failed_at = time.time()
+            raise
+
+    async def sync_once(self) -> None:
+        assert self.interface
+        account_id = await self.mobster.get_account()
+        status = await self.mobster.req_("get_account_status", account_id=account_id)
+        height = int(status["result"]["account"]["next_block_index"]) - 1
+        if self.synced_block is None:
+            records = await self.interface.get_synced_block(account_id)
+            if records:
+                self.synced_block = records[0].get("synced_block")
+        if height == self.synced_block:
+            return
+        if (
+            self.synced_block is None
+            or height - self.synced_block > TRANSACTION_LOG_MAX_BLOCK_GAP
+        ):
+            logs = await self.fetch_all(account_id)
+        else:
+            logs = await self.fetch_blocks(account_id, self.synced_block + 1, height)
+        if logs:
+            await self.interface.put_logs(account_id, json.dumps(list(logs.values())))
+        await self.interface.set_synced_block(account_id, height)
+        self.synced_block = height
+        mirrored_block.set(height)
+
+    async def run(self) -> None:
+        while 1:
+            try:
+                await self.sync()
+            except (KeyError, TypeError, ValueError, OSError, asyncpg.PostgresError):
+                logging.exception("couldn't sync transaction logs")
+            await asyncio.sleep(self.interval)
+
+    async def ready(self) -> bool:
+        "Whether queries can be answered from the mirror, doing the first sync if needed"
+        if not self.interface:
+            return False
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        # after a failed sync, leave retrying to the background task for a while
+        if self.synced_block is None and time.time() - self.failed_at > self.interval:
+            try:
+                await self.sync()
+            except (KeyError, TypeError, ValueError, OSError, asyncpg.PostgresError):
+                logging.exception("couldn't sync transaction logs")
+        return self.synced_block is not None
+
+    def observe(self, log: dict) -> None:
+        "Record a log we just got from full-service, e.g. a newly submitted transaction"
+        if not self.interface or not log.get("transaction_log_id"):
+            return
+        account_id = log.get("account_id") or self.mobster.account_id
+        if account_id:
+            asyncio.create_task(self.save(account_id, [log]))
+
+    async def save(self, account_id: str, logs: list[dict]) -> None:
+        assert self.interface
+        try:
+            await self.interface.put_logs(account_id, json.dumps(logs))
+        except (OSError, asyncpg.PostgresError):
+            logging.exception("couldn't save transaction logs")
+
+    async def get_logs(self, account_id: str) -> list[dict]:
+        "Every log for the account, ordered by block"
+        assert self.interface
+        records = await self.interface.get_logs(account_id) or []
+        return [json.loads(record.get("log")) for record in records]
+
+    async def get_pending(self, account_id: str, from_block: int) -> list[dict]:
+        assert self.interface
+        records = await self.interface.get_pending_logs(account_id, from_block) or []
+        return [json.loads(record.get("log")) for record in records]
+
+
 class LedgerManager(PGInterface):
     def __init__(
         self,
@@ -83,6 +854,25 @@ class LedgerManager(PGInterface):
     ) -> None:
         super().__init__(queries, database, loop)
 
+    async def create_table(self) -> None:
+        """Creates the ledger and its materialized balances, backfilling them from existing rows"""
+        await self.execute(self.queries.get_query("create_table"))
+        await self.execute(self.queries.get_query("create_balances_table"))
+        await self.execute(self.queries.get_query("rebuild_balances"))
+
+    async def reconcile(self, fix: bool = False) -> list[dict]:
+        """Compares materialized balances against the raw ledger, returning mismatched accounts.
+        If fix is set, balances are recomputed from the ledger afterwards
+        and balances of accounts with no ledger rows are dropped."""
+        mismatches = [dict(record) for record in await self.reconcile_balances() or []]
+        if mismatches and fix:
+            # payments recorded meanwhile wait for the rebuild rather than being overwritten
+            async with self.transaction() as txn:
+                await txn.lock_balances()
+                await txn.delete_orphan_balances()
+                await txn.rebuild_balances()
+        return mismatches
+
 
 class Mobster:
     """Class to keep track of a aiohttp session and cached rate"""
@@ -96,8 +886,16 @@ class Mobster:
             ).removesuffix("/wallet") + "/wallet"
 
         self.account_id: Optional[str] = None
+        # cached get_all_accounts result
+        self.accounts: Optional[dict] = None
+        self.accounts_fetched = 0.0
+        self.accounts_lock = asyncio.Lock()
         logging.info("full-service url: %s", url)
         self.url = url
+        self.client = get_full_service_client(url)
+        self.transaction_watcher = TransactionWatcher(self)
+        self.receipt_resolver = ReceiptResolver(self)
+        self.transaction_logs = TransactionLogMirror(self)
 
     async def req_(self, method: str, **params: Any) -> dict:
         logging.info("full-service request: %s", method)
@@ -107,17 +905,29 @@ class Mobster:
         return result
 
     async def req(self, data: dict) -> dict:
-        better_data = {"jsonrpc": "2.0", "id": 1, **data}
         logging.debug("url is %s", self.url)
-        async with aiohttp.TCPConnector(ssl=ssl_context) as conn:
-            async with aiohttp.ClientSession(connector=conn) as sess:
-                # this can hang (forever?) if there's no full-service at that url
-                async with sess.post(
-                    self.url,
-                    data=json.dumps(better_data),
-                    headers={"Content-Type": "application/json"},
-                ) as resp:
-                    return await resp.json()
+        result = await self.client.request(data)
+        if data.get("method") in ACCOUNT_MUTATIONS:
+            self.invalidate_accounts()
+        if data.get("method") == "submit_transaction" and result.get("result"):
+            self.transaction_logs.observe(result["result"].get("transaction_log") or {})
+        return result
+
+    def invalidate_accounts(self) -> None:
+        self.accounts = None
+        self.account_id = None
+
+    async def get_accounts(self, refresh: bool = False) -> dict:
+        """Returns get_all_accounts' account_ids and account_map, fetched at most
+        once per ACCOUNT_CACHE_TTL unless refresh is set or an account changed"""
+        async with self.accounts_lock:
+            stale = time.time() - self.accounts_fetched > ACCOUNT_CACHE_TTL
+            if refresh or stale or self.accounts is None:
+                self.accounts = (await self.req({"method": "get_all_accounts"}))[
+                    "result"
+                ]
+                self.accounts_fetched = time.time()
+            return self.accounts
 
     async def get_all_txos_for_account(self) -> dict[str, dict]:
         txos = (
@@ -187,29 +997,9 @@ class Mobster:
         await asyncio.sleep(10)
         return f"built {built} utxos each containing {output_millimob} mmob/ea"
 
-    rate_cache: tuple[int, Optional[float]] = (0, None)
-
     async def get_rate(self) -> float:
-        """Get the current USD/MOB price and cache it for an hour"""
-        hour = round(time.time() / 3600)  # same value within each hour
-        if self.rate_cache[0] == hour and self.rate_cache[1] is not None:
-            return self.rate_cache[1]
-        try:
-            url = "https://big.one/api/xn/v1/asset_pairs/8e900cb1-6331-4fe7-853c-d678ba136b2f"
-            last_val = await aiohttp.ClientSession().get(url)
-            resp_json = await last_val.json()
-            mob_rate = float(resp_json.get("data").get("ticker").get("close"))
-        except (
-            aiohttp.ClientError,
-            KeyError,
-            TypeError,
-            json.JSONDecodeError,
-        ) as e:
-            logging.error(e)
-            # big.one goes down sometimes, if it does... make up a price
-            mob_rate = 14
-        self.rate_cache = (hour, mob_rate)
-        return mob_rate
+        """Get the current USD/MOB price from the background rate service"""
+        return await rates.rate_service.get_rate()
 
     async def pmob2usd(self, pmob: int) -> float:
         "takes picoMOB, returns USD"
@@ -257,8 +1047,10 @@ class Mobster:
         """Returns either the address set, or the address specified by the secret
         or the first address in the full service instance in that order"""
         acc_id = await self.get_account()
-        res = await self.req({"method": "get_all_accounts"})
-        return res["result"]["account_map"][acc_id]["main_address"]
+        account_map = (await self.get_accounts())["account_map"]
+        if acc_id not in account_map:
+            account_map = (await self.get_accounts(refresh=True))["account_map"]
+        return account_map[acc_id]["main_address"]
 
     async def get_account(self, account_name: Optional[str] = None) -> str:
         """returns the account id matching account_name in Full Service Wallet"""
@@ -270,18 +1062,12 @@ class Mobster:
             account_name = utils.get_secret("FS_ACCOUNT_NAME")
 
         ## get all account IDs for the Wallet / fullservice instance
-        account_ids = (await self.req({"method": "get_all_accounts"}))["result"][
-            "account_ids"
-        ]
+        accounts = await self.get_accounts()
+        account_ids = accounts["account_ids"]
         maybe_account_id = []
         if account_name is not None:
             ## get the account map for the accounts in the wallet
-            account_map = [
-                (await self.req({"method": "get_all_accounts"}))["result"][
-                    "account_map"
-                ][x]
-                for x in account_ids
-            ]
+            account_map = [accounts["account_map"][x] for x in account_ids]
 
             ## get the account_id that matches the name
             maybe_account_id = [
@@ -296,26 +1082,7 @@ class Mobster:
         return account_id
 
     async def get_receipt_amount_pmob(self, receipt_str: str) -> Optional[int]:
-        full_service_receipt = mc_util.b64_receipt_to_full_service_receipt(receipt_str)
-        logging.info("fs receipt: %s", full_service_receipt)
-        params = {
-            "address": await self.get_my_address(),
-            "receiver_receipt": full_service_receipt,
-        }
-        while 1:
-            tx = await self.req(
-                {"method": "check_receiver_receipt_status", "params": params}
-            )
-            logging.info("receipt tx: %s", tx)
-            # {'method': 'check_receiver_receipt_status', 'result':
-            # {'receipt_transaction_status': 'TransactionPending', 'txo': None}, 'jsonrpc': '2.0', 'id': 1}
-            if "error" in tx:
-                return None
-            if tx["result"]["receipt_transaction_status"] == "TransactionPending":
-                await asyncio.sleep(1)
-                continue
-            pmob = int(tx["result"]["txo"]["value_pmob"])
-            return pmob
+        return await self.receipt_resolver.resolve(receipt_str)
 
     account_id: Optional[str] = None
 
@@ -331,14 +1098,19 @@ class Mobster:
         return int(value)
 
     async def get_transactions(self, account_id: str) -> dict[str, dict[str, str]]:
-        return (
-            await self.req(
-                {
-                    "method": "get_all_transaction_logs_for_account",
-                    "params": {"account_id": account_id},
+        # only our own account is mirrored
+        if (
+            account_id == await self.get_account()
+            and await self.transaction_logs.ready()
+        ):
+            try:
+                return {
+                    log["transaction_log_id"]: log
+                    for log in await self.transaction_logs.get_logs(account_id)
                 }
-            )
-        )["result"]["transaction_log_map"]
+            except (OSError, asyncpg.PostgresError):
+                logging.exception("couldn't read mirrored transaction logs")
+        return await self.transaction_logs.fetch_all(account_id)
 
     async def build_single_txo_proposal(self, recipient: str, amount: str) -> dict:
         """
@@ -399,6 +1171,18 @@ class Mobster:
           dict: transaction records ordered by block
         """
 
+        if await self.transaction_logs.ready():
+            try:
+                logs = await self.transaction_logs.get_logs(await self.get_account())
+                return {
+                    "result": {
+                        "transaction_log_map": {
+                            log["transaction_log_id"]: log for log in logs
+                        }
+                    }
+                }
+            except (OSError, asyncpg.PostgresError):
+                logging.exception("couldn't read mirrored transaction logs")
         request = dict(method="get_all_transaction_logs_ordered_by_block")
         return await self.req(request)
 
@@ -428,6 +1212,13 @@ class Mobster:
           list[dict]: list of pending transactions
         """
 
+        if await self.transaction_logs.ready():
+            try:
+                return await self.transaction_logs.get_pending(
+                    await self.get_account(), from_block
+                )
+            except (OSError, asyncpg.PostgresError):
+                logging.exception("couldn't read mirrored transaction logs")
         pending_transactions: list[dict] = []
         tx_logs = await self.get_all_transaction_logs_by_block()
         tx_logs = tx_logs.get("result", {}).get("transaction_log_map", {})
@@ -446,15 +1237,16 @@ class StatefulMobster(Mobster):
     def __init__(self) -> None:
         self.ledger_manager = LedgerManager()
         self.invoice_manager = InvoiceManager()
+        self.invoice_allocator = InvoiceAllocator(self.invoice_manager)
         super().__init__()
 
     async def create_invoice(self, amount_usd: float, account: str, memo: str) -> float:
-        while 1:
-            try:
-                mob_price_exact = await self.usd2mob(amount_usd, perturb=True)
-                await self.invoice_manager.create_invoice(
-                    account, mc_util.mob2pmob(mob_price_exact), memo
-                )
-                return mob_price_exact
-            except asyncpg.UniqueViolationError:
-                pass
+        "Returns a unique MOB amount to ask for, recorded as an invoice for account"
+        mob_price = await self.usd2mob(amount_usd)
+        amount = await self.invoice_allocator.allocate(
+            mc_util.mob2pmob(mob_price), account, memo
+        )
+        return float(mc_util.pmob2mob(amount))
+
+    async def get_invoice_by_amount(self, amount_pmob: int) -> Optional[dict]:
+        return await self.invoice_allocator.lookup(amount_pmob)
@@ -0,0 +1,138 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+Concurrent payouts to a list of recipients.
+Every recipient is paid from its own pre-reserved TXO, so a bounded number of
+workers can build and confirm payments at once without colliding over inputs.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from forest import utils
+from forest.pdictng import aPersistDictOfLists
+from forest.utxo import UTXOManager
+
+PAYOUT_CONCURRENCY = int(utils.get_secret("PAYOUT_CONCURRENCY") or 8)
+PROGRESS_INTERVAL = float(utils.get_secret("PAYOUT_PROGRESS_INTERVAL") or 30)
+
+# pays a recipient from the given txo, returning whether it went through
+Pay = Callable[[str, str], Awaitable[bool]]
+# follow-up for a recipient once their payment is recorded, e.g. telling them
+OnPaid = Callable[[str], Awaitable[Any]]
+Report = Callable[[str], Awaitable[Any]]
+
+
+class PayoutEngine:
+    """Pays a list of recipients with at most `concurrency` payments in flight.
+    Successful recipients are appended to paid_store[paid_key] as soon as their
+    payment is confirmed, before on_paid runs, so an interrupted payout can be rerun
+    without paying anyone twice."""
+
+    def __init__(
+        self,
+        utxos: UTXOManager,
+        concurrency: int = PAYOUT_CONCURRENCY,
+        progress_interval: float = PROGRESS_INTERVAL,
+    ) -> None:
+        self.utxos = utxos
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.total = 0
+        self.paid: list[str] = []
+        self.failed: list[str] = []
+
+    def progress(self) -> str:
+        done = len(self.paid) + len(self.failed)
+        return f"paid {len(self.paid)}/{self.total}, {len(self.failed)} failed, {self.total - done} remaining"
+
+    async def reserve(
+        self, count: int, min_pmob: int, report: Report, timeout: float
+    ) -> list[str]:
+        txos = await self.utxos.acquire(min_pmob, count)
+        if len(txos) < count:
+            await report("Please wait! Insufficient number of utxos!\nBuilding more...")
+            txos += await self.utxos.acquire(min_pmob, count - len(txos), timeout)
+            if len(txos) < count:
+                await report(f"Only found {len(txos)} of {count} utxos")
+        return txos
+
+    async def worker(
+        self,
+        queue: "asyncio.Queue[tuple[str, str]]",
+        pay: Pay,
+        paid_store: Optional[aPersistDictOfLists[str]],
+        paid_key: str,
+        on_paid: Optional[OnPaid],
+    ) -> None:
+        while not queue.empty():
+            recipient, txo = queue.get_nowait()
+            try:
+                success = await pay(recipient, txo)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("payout to %s failed", recipient)
+                success = False
+            # if the payment didn't go through, the next refresh gives the txo back
+            self.utxos.spend([txo])
+            if not success:
+                self.failed.append(recipient)
+                continue
+            self.paid.append(recipient)
+            try:
+                if paid_store is not None:
+                    await paid_store.extend(paid_key, recipient)
+                if on_paid:
+                    await on_paid(recipient)
+            except Exception:  # pylint: disable=broad-except
+                # they were paid regardless, so don't count them as failed
+                logging.exception("follow-up for paid recipient %s failed", recipient)
+
+    async def report_progress(self, report: Report) -> None:
+        while 1:
+            await asyncio.sleep(self.progress_interval)
+            await report(self.progress())
+
+    async def run(  # pylint: disable=too-many-arguments
+        self,
+        recipients: list[str],
+        min_pmob: int,
+        pay: Pay,
+        report: Report,
+        paid_store: Optional[aPersistDictOfLists[str]] = None,
+        paid_key: str = "",
+        utxo_timeout: float = 600,
+        on_paid: Optional[OnPaid] = None,
+    ) -> list[str]:
+        """Pays every recipient not already in paid_store[paid_key] using TXOs worth
+        at least min_pmob, reporting progress along the way. Returns those that failed.
+        """
+        if paid_store is not None:
+            already_paid = await paid_store.get(paid_key, [])
+            recipients = [r for r in recipients if r not in already_paid]
+        self.total, self.paid, self.failed = len(recipients), [], []
+        txos = await self.reserve(len(recipients), min_pmob, report, utxo_timeout)
+        # recipients we couldn't find a txo for aren't attempted
+        self.failed += recipients[len(txos) :]
+        queue: "asyncio.Queue[tuple[str, str]]" = asyncio.Queue()
+        for pair in zip(recipients, txos):
+            queue.put_nowait(pair)
+        start = time.time()
+        reporter = asyncio.create_task(self.report_progress(report))
+        try:
+            await asyncio.gather(
+                *(
+                    self.worker(queue, pay, paid_store, paid_key, on_paid)
+                    for _ in range(min(self.concurrency, queue.qsize()))
+                )
+            )
+        finally:
+            reporter.cancel()
+            self.utxos.release(txos)
+        logging.info(
+            "payout finished in %.1fs: %s", time.time() - start, self.progress()
+        )
+        await report(self.progress())
+        return self.failed
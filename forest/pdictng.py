@@ -3,11 +3,21 @@
 # MIT LICENSE
 import asyncio
 import json
+import logging
 import os
 import time
+import uuid
+import weakref
 from typing import Any, Generic, Optional, TypeVar, overload
 import aiohttp
-from forest.cryptography import get_ciphertext_value, get_cleartext_value, hash_salt
+from prometheus_client import Gauge, Histogram
+from forest.cryptography import (
+    get_ciphertext_value,
+    get_cleartext_value,
+    hash_salt,
+    seal,
+    unseal,
+)
 
 NAMESPACE = os.getenv("FLY_APP_NAME") or open("/etc/hostname").read().strip()
 pAUTH = os.getenv("PAUTH", "")
@@ -16,6 +26,42 @@ pURL = os.getenv("PURL", "https://gusc1-charming-parrot-31440.upstash.io")
 if not pAUTH:
     raise ValueError("Need to set PAUTH envvar for persistence")
 
+# "blob" stores each dict as one encrypted value, rewritten on every change.
+# "keys" stores each key as its own encrypted record, so a write only uploads
+# that key's value. Dicts still in the blob layout are migrated when first loaded.
+PDICT_LAYOUT = os.getenv("PDICT_LAYOUT", "blob")
+# record marking a dict as migrated, so an emptied dict doesn't reload the old blob
+LAYOUT_MARKER = "__layout__"
+# with write_delay set, mutations apply in memory at once and are uploaded together
+# at most this many seconds later. 0 uploads every mutation before returning.
+PDICT_WRITE_DELAY = float(os.getenv("PDICT_WRITE_DELAY") or 0)
+
+# with a snapshot dir, each dict keeps an encrypted copy of itself there, so a restart
+# can serve reads before the remote copy is fetched.
+PDICT_SNAPSHOT_DIR = os.getenv("PDICT_SNAPSHOT_DIR", "")
+# snapshots are rewritten at most this often
+SNAPSHOT_DELAY = 1.0
+# tries at catching a snapshot up with the remote copy before carrying on without
+RECONCILE_ATTEMPTS = 5
+# every upload carries a new version: the blob under this field, and each record
+# in the keys layout under "ver". A snapshot is current while its versions match.
+VERSION_FIELD = "__version__"
+
+dirty_keys = Gauge("pdict_dirty_keys", "Keys changed but not yet uploaded", ["tag"])
+flush_lag = Histogram(
+    "pdict_flush_lag_seconds",
+    "Time from a write-behind mutation to its upload",
+    ["tag"],
+    buckets=[0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30],
+)
+# every dict with write_delay, so they can all be flushed at shutdown
+write_behind_dicts: "weakref.WeakSet[aPersistDict]" = weakref.WeakSet()
+
+
+async def flush_all() -> None:
+    "Upload every pending write-behind mutation"
+    await asyncio.gather(*(pdict.flush() for pdict in list(write_behind_dicts)))
+
 
 class persistentKVStoreClient:
     async def post(self, key: str, data: str) -> str:
@@ -24,6 +70,17 @@ class persistentKVStoreClient:
     async def get(self, key: str) -> str:
         raise NotImplementedError
 
+    async def hset(self, key: str, field: str, data: str) -> str:
+        "Set one field of the record set at key"
+        raise NotImplementedError
+
+    async def hdel(self, key: str, field: str) -> str:
+        raise NotImplementedError
+
+    async def hgetall(self, key: str) -> list[str]:
+        "Returns the cleartext of every field set at key"
+        raise NotImplementedError
+
 
 class fasterpKVStoreClient(persistentKVStoreClient):
     """Strongly consistent, persistent storage.
@@ -61,11 +118,36 @@ class fasterpKVStoreClient(persistentKVStoreClient):
         key = hash_salt(f"{self.namespace}_{key}")
         async with self.conn.get(f"{self.url}/GET/{key}", headers=self.headers) as resp:
             res = await resp.json()
-            if "result" in res:
+            # missing keys are {"result": null}
+            if res.get("result"):
                 return get_cleartext_value(res["result"])
 
         return ""
 
+    async def hset(self, key: str, field: str, data: str) -> str:
+        key = hash_salt(f"{self.namespace}_{key}")
+        data = get_ciphertext_value(data)
+        async with self.conn.post(
+            f"{self.url}/HSET/{key}/{hash_salt(field)}", headers=self.headers, data=data
+        ) as resp:
+            return await resp.json()
+
+    async def hdel(self, key: str, field: str) -> str:
+        key = hash_salt(f"{self.namespace}_{key}")
+        async with self.conn.post(
+            f"{self.url}/HDEL/{key}/{hash_salt(field)}", headers=self.headers
+        ) as resp:
+            return await resp.json()
+
+    async def hgetall(self, key: str) -> list[str]:
+        key = hash_salt(f"{self.namespace}_{key}")
+        async with self.conn.get(
+            f"{self.url}/HGETALL/{key}", headers=self.headers
+        ) as resp:
+            res = await resp.json()
+        # [field, value, field, value, ...]
+        return [get_cleartext_value(value) for value in res.get("result", [])[1::2]]
+
 
 class fastpKVStoreClient(persistentKVStoreClient):
     """Strongly consistent, persistent storage.
@@ -108,7 +190,10 @@ class fastpKVStoreClient(persistentKVStoreClient):
         }
 
     async def post(self, key: str, data: str) -> str:
-        key = hash_salt(key)
+        return await self.put(hash_salt(key), data)
+
+    async def put(self, key: str, data: str) -> str:
+        "Upsert data at an already hashed key"
         data = get_ciphertext_value(data)
         # try to set
         if self.exists.get(key):
@@ -172,6 +257,27 @@ class fastpKVStoreClient(persistentKVStoreClient):
                 return get_cleartext_value(maybe_res)
             return ""
 
+    # a record set is every row whose key_ starts with the hashed key
+    async def hset(self, key: str, field: str, data: str) -> str:
+        return await self.put(f"{hash_salt(key)}.{hash_salt(field)}", data)
+
+    async def hdel(self, key: str, field: str) -> str:
+        async with self.conn.delete(
+            f"{self.url}?key_=eq.{hash_salt(key)}.{hash_salt(field)}&namespace=eq.{self.namespace}",
+            headers=self.headers,
+        ) as resp:
+            return await resp.text()
+
+    async def hgetall(self, key: str) -> list[str]:
+        async with self.conn.get(
+            f"{self.url}?select=key_,value&key_=like.{hash_salt(key)}.*&namespace=eq.{self.namespace}",
+            headers=self.headers,
+        ) as resp:
+            rows = await resp.json()
+        for row in rows:
+            self.exists[row["key_"]] = True
+        return [get_cleartext_value(row["value"]) for row in rows]
+
 
 V = TypeVar("V")
 # V = TypeVar("V", str, int, list, dict[str, str])
@@ -191,7 +297,14 @@ class aPersistDict(Generic[V]):
         - config info
     in a way that are persisted across reboots.
     No schemas and privacy preserving, but could be faster.
-    Each write takes about 70 ms.
+    Each write takes about 70 ms. In the blob layout that's plus uploading the whole
+    dict; in the "keys" layout (layout="keys" or PDICT_LAYOUT=keys) only the changed key
+    is uploaded.
+    With write_delay=seconds (or PDICT_WRITE_DELAY), mutations return as soon as
+    they're applied in memory and are uploaded together within that delay;
+    await flush() where a write must be stored before going on.
+    With snapshot_dir (or PDICT_SNAPSHOT_DIR), a restart reads from a local snapshot
+    straight away and catches up with the remote copy in the background.
 
     This takes a type parameter for the value
     """
@@ -205,9 +318,27 @@ class aPersistDict(Generic[V]):
             self.tag = args[0]
         if "tag" in kwargs:
             self.tag = kwargs.pop("tag")
+        self.layout = kwargs.pop("layout", PDICT_LAYOUT)
+        self.write_delay = float(kwargs.pop("write_delay", PDICT_WRITE_DELAY))
+        # keys changed since the last upload, and when the oldest change was made
+        self.dirty: set[str] = set()
+        self.dirty_since: Optional[float] = None
+        self.flush_task: Optional[asyncio.Task] = None
+        self.flush_lock = asyncio.Lock()
+        if self.write_delay:
+            write_behind_dicts.add(self)
+        self.snapshot_dir = kwargs.pop("snapshot_dir", PDICT_SNAPSHOT_DIR)
+        # version of each uploaded unit (the blob, or each key's record) dict_ matches
+        self.versions: dict[str, str] = {}
+        # keys written since starting from a snapshot, which win over the remote copy
+        self.changed: set[str] = set()
+        self.snapshot_task: Optional[asyncio.Task] = None
         self.dict_: dict[str, Any] = {}
+        self.warm = self.load_snapshot()
         self.client: persistentKVStoreClient = (
-            fastpKVStoreClient() if "supabase" in pURL else fasterpKVStoreClient()
+            fastpKVStoreClient(pURL)
+            if "supabase" in pURL
+            else fasterpKVStoreClient(pURL)
         )
         self.rwlock = asyncio.Lock()
         self.loop = asyncio.get_event_loop()
@@ -230,14 +361,239 @@ class aPersistDict(Generic[V]):
             raise ValueError("Can't set value. write_task incomplete.")
         self.write_task = asyncio.create_task(self.set(key, value))
 
+    @property
+    def client_key(self) -> str:
+        return f"Persist_{self.tag}_{NAMESPACE}"
+
+    @property
+    def records_key(self) -> str:
+        return f"PersistKeys_{self.tag}_{NAMESPACE}"
+
+    @property
+    def snapshot_path(self) -> str:
+        return os.path.join(self.snapshot_dir, f"{hash_salt(self.client_key)}.pdict")
+
     async def finish_init(self, **kwargs: Any) -> None:
         """Does the asynchrnous part of the initialisation process."""
+        if self.warm:
+            # reads are served from the snapshot meanwhile, so don't hold the lock
+            delay = 1.0
+            for attempt in range(1, RECONCILE_ATTEMPTS + 1):
+                try:
+                    await self.reconcile()
+                    break
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception(
+                        "couldn't reconcile %s (attempt %s)", self.tag, attempt
+                    )
+                    if attempt < RECONCILE_ATTEMPTS:
+                        await asyncio.sleep(delay)
+                        delay *= 2
+            else:
+                # keep the snapshot, but stop holding writes back
+                async with self.rwlock:
+                    self.end_warm_start()
+            async with self.rwlock:
+                self.dict_.update(**kwargs)
+            return
         async with self.rwlock:
-            key = f"Persist_{self.tag}_{NAMESPACE}"
-            result = await self.client.get(key)
-            if result:
-                self.dict_ = json.loads(result)
+            self.dict_, self.versions = await self.fetch()
             self.dict_.update(**kwargs)
+        self.schedule_snapshot()
+
+    async def fetch(self) -> tuple[dict[str, Any], dict[str, str]]:
+        "Download the remote copy and its versions"
+        if self.layout == "keys":
+            return await self.load_records()
+        result = await self.client.get(self.client_key)
+        blob = json.loads(result) if result else {}
+        version = blob.pop(VERSION_FIELD, None)
+        return blob, {self.client_key: version} if version else {}
+
+    async def load_records(self) -> tuple[dict[str, Any], dict[str, str]]:
+        "Load a dict stored one record per key, migrating it from the blob layout if needed"
+        migrated = False
+        records, versions = {}, {}
+        for record in map(json.loads, await self.client.hgetall(self.records_key)):
+            if record.get("k") == LAYOUT_MARKER:
+                migrated = True
+            else:
+                records[record["k"]] = record["v"]
+                if "ver" in record:
+                    versions[record["k"]] = record["ver"]
+        if migrated:
+            return records, versions
+        # the old blob is left as it was, in case we need to go back to it
+        result = await self.client.get(self.client_key)
+        if result:
+            blob = json.loads(result)
+            blob.pop(VERSION_FIELD, None)
+            records = blob | records
+            await asyncio.gather(
+                *(
+                    self.upload_record(key, json.dumps({"k": key, "v": value}))
+                    for key, value in records.items()
+                )
+            )
+        await self.client.hset(
+            self.records_key, LAYOUT_MARKER, json.dumps({"k": LAYOUT_MARKER, "v": 1})
+        )
+        return records, versions
+
+    def load_snapshot(self) -> bool:
+        "Start from the local snapshot, if there is one"
+        if not self.snapshot_dir:
+            return False
+        try:
+            with open(self.snapshot_path, "rb") as snapshot_file:
+                snapshot = json.loads(unseal(snapshot_file.read()))
+            self.dict_, self.versions = snapshot["dict"], snapshot["versions"]
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError):
+            logging.exception("ignoring unreadable snapshot for %s", self.tag)
+            return False
+        return True
+
+    async def reconcile(self) -> None:
+        """Replace the snapshot with the remote copy if it's changed since,
+        then upload whatever was written meanwhile"""
+        remote, versions = await self.fetch()
+        async with self.rwlock:
+            if not versions or versions != self.versions:
+                for key in self.changed:
+                    if key in self.dict_:
+                        remote[key] = self.dict_[key]
+                    else:
+                        remote.pop(key, None)
+                self.dict_, self.versions = remote, versions
+            else:
+                logging.debug("snapshot of %s is current", self.tag)
+            self.end_warm_start()
+        self.schedule_snapshot()
+
+    def end_warm_start(self) -> None:
+        "Upload what was written since starting from the snapshot, like write-behind"
+        changed, self.changed, self.warm = self.changed, set(), False
+        for key in changed:
+            self.mark_dirty(key)
+
+    def write_snapshot(self, data: bytes) -> None:
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        # written aside and renamed, so a crash can't leave a torn snapshot
+        temp_path = f"{self.snapshot_path}.tmp"
+        with open(temp_path, "wb") as snapshot_file:
+            snapshot_file.write(data)
+        os.replace(temp_path, self.snapshot_path)
+
+    async def save_snapshot(self) -> None:
+        if not self.snapshot_dir:
+            return
+        snapshot = json.dumps({"versions": self.versions, "dict": self.dict_})
+        try:
+            await asyncio.to_thread(self.write_snapshot, seal(snapshot.encode()))
+        except OSError:
+            logging.exception("couldn't save snapshot for %s", self.tag)
+
+    def schedule_snapshot(self) -> None:
+        if self.snapshot_dir and (not self.snapshot_task or self.snapshot_task.done()):
+            self.snapshot_task = asyncio.create_task(self.save_snapshot_later())
+
+    async def save_snapshot_later(self) -> None:
+        await asyncio.sleep(SNAPSHOT_DELAY)
+        await self.save_snapshot()
+
+    async def upload(self, keys: list[str]) -> str:
+        "Upload keys (or the whole blob) under a new version"
+        version = uuid.uuid4().hex
+        records: Optional[dict[str, Optional[str]]] = None
+        if self.layout == "keys":
+            records = {key: self.record(key, version) for key in keys}
+            uploads = [self.upload_record(*item) for item in records.items()]
+        else:
+            uploads = [self.client.post(self.client_key, self.blob(version))]
+        results = await asyncio.gather(*uploads)
+        self.stamp(version, records)
+        self.schedule_snapshot()
+        return results[0]
+
+    def stamp(self, version: str, records: Optional[dict[str, Optional[str]]]) -> None:
+        "Note the version the blob, or these records, were stored with"
+        if records is None:
+            self.versions = {self.client_key: version}
+            return
+        for key, record in records.items():
+            if record is None:
+                self.versions.pop(key, None)
+            else:
+                self.versions[key] = version
+
+    def blob(self, version: str) -> str:
+        return json.dumps({**self.dict_, VERSION_FIELD: version})
+
+    def record(self, key: str, version: str) -> Optional[str]:
+        if key in self.dict_:
+            return json.dumps({"k": key, "v": self.dict_[key], "ver": version})
+        return None
+
+    async def upload_record(self, key: str, record: Optional[str]) -> str:
+        if record is not None:
+            return await self.client.hset(self.records_key, key, record)
+        return await self.client.hdel(self.records_key, key)
+
+    def mark_dirty(self, key: str) -> None:
+        # so that flush_all uploads it at shutdown
+        write_behind_dicts.add(self)
+        self.dirty.add(key)
+        if self.dirty_since is None:
+            self.dirty_since = time.time()
+        dirty_keys.labels(self.tag).set(len(self.dirty))
+        if not self.flush_task or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self, delay: Optional[float] = None) -> None:
+        delay = self.write_delay if delay is None else delay
+        await asyncio.sleep(delay)
+        try:
+            await self.flush()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            retry = min(max(delay * 2, 1.0), 60.0)
+            logging.exception("couldn't flush %s, retrying in %ss", self.tag, retry)
+            if self.dirty:
+                self.flush_task = asyncio.create_task(self.flush_later(retry))
+
+    async def flush(self) -> None:
+        """Upload pending write-behind mutations, coalesced into one upload per key
+        (or a single upload in the blob layout). Returns once they're stored."""
+        async with self.flush_lock:
+            async with self.rwlock:
+                if not self.dirty:
+                    return
+                keys, since = self.dirty, self.dirty_since or time.time()
+                self.dirty, self.dirty_since = set(), None
+                version = uuid.uuid4().hex
+                records: Optional[dict[str, Optional[str]]] = None
+                if self.layout == "keys":
+                    records = {key: self.record(key, version) for key in keys}
+                else:
+                    blob = self.blob(version)
+            try:
+                if records is not None:
+                    await asyncio.gather(
+                        *(self.upload_record(*item) for item in records.items())
+                    )
+                else:
+                    await self.client.post(self.client_key, blob)
+            except BaseException:
+                # keep them dirty so the next flush tries again
+                self.dirty |= keys
+                self.dirty_since = min(since, self.dirty_since or since)
+                raise
+            finally:
+                dirty_keys.labels(self.tag).set(len(self.dirty))
+            self.stamp(version, records)
+            flush_lag.labels(self.tag).observe(time.time() - since)
+        await self.save_snapshot()
 
     @overload
     async def get(self, key: str, default: V) -> V:
@@ -295,9 +651,15 @@ class aPersistDict(Generic[V]):
             self.dict_.update({key: value})
         elif key and value is None and key in self.dict_:
             self.dict_.pop(key)
-        client_key = f"Persist_{self.tag}_{NAMESPACE}"
-        client_value = json.dumps(self.dict_)
-        return await self.client.post(client_key, client_value)
+        if self.warm:
+            # uploaded once reconcile has merged in the remote copy
+            self.changed.add(key)
+            self.schedule_snapshot()
+            return ""
+        if self.write_delay:
+            self.mark_dirty(key)
+            return ""
+        return await self.upload([key])
 
     async def set(self, key: str, value: Optional[V]) -> str:
         """Sets a value at a given key, returns metadata."""
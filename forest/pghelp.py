@@ -4,12 +4,18 @@
 
 import asyncio
 import copy
+import hashlib
+import json
 import logging
 import os
 import time
 from contextlib import asynccontextmanager
 from typing import Any, AsyncGenerator, Callable, Optional, Union
 
+from prometheus_client import Counter, Histogram
+
+from forest.cryptography import hash_salt
+
 try:
     import asyncpg
 
@@ -25,6 +31,20 @@ Loop = Optional[asyncio.events.AbstractEventLoop]
 AUTOCREATE = "true" in os.getenv("AUTOCREATE_TABLES", "false").lower()
 MAX_RESP_LOG_LEN = int(os.getenv("MAX_RESP_LOG_LEN", "256"))
 LOG_LEVEL_DEBUG = bool(os.getenv("DEBUG", None))
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+
+query_latency = Histogram(
+    "pg_query_latency_seconds",
+    "Latency of named PGExpressions queries",
+    ["table", "expression"],
+)
+query_rows = Counter(
+    "pg_query_rows",
+    "Rows returned by named PGExpressions queries",
+    ["table", "expression"],
+)
+# "table.expression" -> [calls, total seconds, max seconds] since startup
+query_stats: dict[str, list[float]] = {}
 
 
 def get_logger(name: str) -> logging.Logger:
@@ -39,6 +59,46 @@ def get_logger(name: str) -> logging.Logger:
     return logger
 
 
+def hash_args(args: tuple) -> list[str]:
+    """Fingerprints each query argument so slow queries can be correlated without logging PII.
+    The hashes are keyed with the secret SALT, since phone numbers and uuids are few enough
+    to brute-force an unsalted hash"""
+    return [f"{type(arg).__name__}:{hash_salt(repr(arg))[:12]}" for arg in args]
+
+
+def record_query(
+    table: str, expression: str, args: tuple, elapsed: float, resp: Any
+) -> None:
+    """Updates metrics and running stats for a named query, logging it if it was slow"""
+    rows = len(resp) if isinstance(resp, list) else 0
+    query_latency.labels(table, expression).observe(elapsed)
+    query_rows.labels(table, expression).inc(rows)
+    stats = query_stats.setdefault(f"{table}.{expression}", [0, 0.0, 0.0])
+    stats[0] += 1
+    stats[1] += elapsed
+    stats[2] = max(stats[2], elapsed)
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        logging.warning(
+            "slow query %s.%s took %.4fs and returned %s rows, args: %s",
+            table,
+            expression,
+            elapsed,
+            rows,
+            hash_args(args),
+        )
+
+
+def slowest_queries(limit: int = 10) -> list[tuple[str, int, float, float]]:
+    """Returns (expression, calls, mean seconds, max seconds) for the
+    expressions with the highest mean latency since startup"""
+    summary = [
+        (name, int(calls), total / calls, max_)
+        for name, (calls, total, max_) in query_stats.items()
+        if calls
+    ]
+    return sorted(summary, key=lambda stat: stat[2], reverse=True)[:limit]
+
+
 # this should be used for every insance
 
 
@@ -79,6 +139,142 @@ class OneTruePool:
 pool = OneTruePool()
 
 
+# notifies <table>_changes with {"table", "op", "key"} for every row change.
+# the key column is passed as the trigger argument; row bodies aren't sent
+# because NOTIFY payloads are capped at 8000 bytes
+NOTIFY_FUNCTION = """CREATE OR REPLACE FUNCTION forest_notify_change() RETURNS trigger AS $$
+DECLARE
+    row_json JSONB;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_json := to_jsonb(OLD);
+    ELSE
+        row_json := to_jsonb(NEW);
+    END IF;
+    PERFORM pg_notify(TG_TABLE_NAME || '_changes', json_build_object(
+        'table', TG_TABLE_NAME,
+        'op', TG_OP,
+        'key', row_json -> TG_ARGV[0]
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;"""
+
+NOTIFY_TRIGGER = """DROP TRIGGER IF EXISTS {table}_notify_change ON {table};
+CREATE TRIGGER {table}_notify_change AFTER INSERT OR UPDATE OR DELETE ON {table}
+    FOR EACH ROW EXECUTE PROCEDURE forest_notify_change('{key_column}');"""
+
+ChangeCallback = Callable[[dict], Any]
+
+
+class ChangeFeed:
+    """Holds one dedicated LISTEN connection and dispatches notifications to subscribers
+    on the event loop. Callbacks receive the decoded payload and may be coroutine functions.
+    If the connection drops, it reconnects with backoff and sends every subscriber
+    {"op": "RECONNECT"}, since notifications may have been missed in the meantime."""
+
+    def __init__(self) -> None:
+        self.connection: Optional[asyncpg.Connection] = None
+        self.database = ""
+        self.subscribers: dict[str, list[ChangeCallback]] = {}
+        self.reconnect_task: Optional[asyncio.Task] = None
+        # so that concurrent subscribers don't each open a connection.
+        # made on first use, since this is created at import time
+        self.connect_lock: Optional[asyncio.Lock] = None
+        self.closing = False
+
+    def connected(self) -> bool:
+        return bool(self.connection and not self.connection.is_closed())
+
+    async def connect(self, database: str) -> None:
+        if not self.connect_lock:
+            self.connect_lock = asyncio.Lock()
+        async with self.connect_lock:
+            if self.connected():
+                return
+            self.database = database
+            self.connection = await asyncpg.connect(database)
+            self.connection.add_termination_listener(self.on_termination)
+            for channel in list(self.subscribers):
+                await self.connection.add_listener(channel, self.dispatch)
+            logging.info("listening for changes on %s", list(self.subscribers))
+
+    async def subscribe(
+        self, database: str, channel: str, callback: ChangeCallback
+    ) -> None:
+        """Call callback with the payload of every notification on channel"""
+        new_channel = channel not in self.subscribers
+        self.subscribers.setdefault(channel, []).append(callback)
+        if not self.connected():
+            await self.connect(database)
+        # a connect that was already underway may have missed this channel;
+        # listening twice with the same callback is a no-op
+        if new_channel and self.connection:
+            await self.connection.add_listener(channel, self.dispatch)
+
+    async def unsubscribe(self, channel: str, callback: ChangeCallback) -> None:
+        callbacks = self.subscribers.get(channel, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks and channel in self.subscribers:
+            self.subscribers.pop(channel)
+            if self.connected():
+                assert self.connection
+                await self.connection.remove_listener(channel, self.dispatch)
+
+    def notify_subscribers(self, channel: str, payload: dict) -> None:
+        for callback in list(self.subscribers.get(channel, [])):
+            try:
+                result = callback(payload)
+                if asyncio.iscoroutine(result):
+                    asyncio.create_task(result)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("change callback for %s failed", channel)
+
+    def dispatch(
+        self, _connection: asyncpg.Connection, _pid: int, channel: str, payload: str
+    ) -> None:
+        """asyncpg listener, called on the event loop for each notification"""
+        try:
+            decoded = json.loads(payload) if payload else {}
+        except json.JSONDecodeError:
+            decoded = {"payload": payload}
+        self.notify_subscribers(channel, decoded)
+
+    def on_termination(self, _connection: asyncpg.Connection) -> None:
+        if self.closing:
+            return
+        logging.warning("change feed connection lost, reconnecting")
+        if not self.reconnect_task or self.reconnect_task.done():
+            self.reconnect_task = asyncio.create_task(self.reconnect())
+
+    async def reconnect(self) -> None:
+        backoff = 0.5
+        while not self.closing:
+            try:
+                await self.connect(self.database)
+                break
+            except (
+                OSError,
+                asyncio.TimeoutError,
+                asyncpg.PostgresError,
+                asyncpg.InterfaceError,
+            ) as e:
+                logging.error("couldn't reconnect change feed: %r", e)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+        for channel in self.subscribers:
+            self.notify_subscribers(channel, {"op": "RECONNECT"})
+
+    async def close(self) -> None:
+        self.closing = True
+        if self.connection and not self.connection.is_closed():
+            await self.connection.close()
+
+
+change_feed = ChangeFeed()
+
+
 class SimpleInterface:
     def __init__(self, database: str) -> None:
         self.database = database
@@ -93,7 +289,15 @@ class SimpleInterface:
             yield conn
 
 
+# every PGExpressions with a table, so that bootstrap_schema can create them at startup
+registry: dict[str, "PGExpressions"] = {}
+
+
 class PGExpressions(dict):
+    """Named statements for a table. Besides create_table, statements named create_*
+    that start with CREATE (indexes, triggers, auxiliary tables) and statements named
+    migrate* are run by bootstrap_schema, so they must be idempotent."""
+
     def __init__(self, table: str = "", **kwargs: str) -> None:
         self.table = table
         self.logger = get_logger(f"{self.table}_expressions")
@@ -104,11 +308,109 @@ class PGExpressions(dict):
             ] = f"SELECT * FROM pg_tables WHERE tablename = '{self.table}';"
         if "create_table" not in self:
             self.logger.warning(f"'create_table' not defined for {self.table}")
+        if self.table:
+            registry[self.table] = self
 
     def get_query(self, key: str) -> str:
         self.logger.debug(f"self.get invoked for {key}")
         return dict.__getitem__(self, key).replace("{self.table}", self.table)
 
+    def schema_statements(self) -> list[str]:
+        """create_* statements other than create_table that define schema rather than rows"""
+        return [
+            key
+            for key in self
+            if key.startswith("create_")
+            and key != "create_table"
+            and self.get_query(key).lstrip().upper().startswith("CREATE")
+        ]
+
+    def migrations(self) -> list[str]:
+        return sorted(key for key in self if key.startswith("migrate"))
+
+
+MigrationExpressions = PGExpressions(
+    table="forest_migrations",
+    create_table="CREATE TABLE IF NOT EXISTS {self.table} (\
+        table_name TEXT, \
+        name TEXT, \
+        checksum TEXT, \
+        applied TIMESTAMP DEFAULT now(), \
+        PRIMARY KEY (table_name, name));",
+    get_migrations="SELECT table_name, name, checksum FROM {self.table};",
+    record_migration="INSERT INTO {self.table} (table_name, name, checksum) \
+        VALUES ($1, $2, $3) ON CONFLICT (table_name, name) \
+        DO UPDATE SET checksum=$3, applied=now();",
+)
+
+
+async def ensure_schema(
+    queries: PGExpressions, existing: set[str], applied: dict[tuple[str, str], str]
+) -> None:
+    """Create a table if it's missing, then its indexes, then any migrations
+    that haven't been applied (or whose statement has changed since)"""
+    async with pool.acquire() as connection:
+        if queries.table not in existing:
+            if not AUTOCREATE or "create_table" not in queries:
+                logging.warning(
+                    "not autocreating! table %s does not exist", queries.table
+                )
+                return
+            logging.info("creating table %s", queries.table)
+            await connection.execute(queries.get_query("create_table"))
+        for key in queries.schema_statements():
+            await connection.execute(queries.get_query(key))
+        for key in queries.migrations():
+            statement = queries.get_query(key)
+            checksum = hashlib.sha256(statement.encode()).hexdigest()[:16]
+            if applied.get((queries.table, key)) == checksum:
+                continue
+            logging.info("applying migration %s.%s", queries.table, key)
+            await connection.execute(statement)
+            await connection.execute(
+                MigrationExpressions.get_query("record_migration"),
+                queries.table,
+                key,
+                checksum,
+            )
+
+
+async def bootstrap_schema(
+    database: str, expressions: Optional[list[PGExpressions]] = None
+) -> None:
+    """Concurrently create every registered (or given) table, index and pending migration,
+    so the first real query doesn't pay for DDL. Failures are logged per table."""
+    start_time = time.time()
+    if not pool.pool:
+        await pool.connect(database, "schema bootstrap")
+    async with pool.acquire() as connection:
+        await connection.execute(MigrationExpressions.get_query("create_table"))
+        existing = {
+            record["tablename"]
+            for record in await connection.fetch("SELECT tablename FROM pg_tables;")
+        }
+        applied = {
+            (record["table_name"], record["name"]): record["checksum"]
+            for record in await connection.fetch(
+                MigrationExpressions.get_query("get_migrations")
+            )
+        }
+    targets = [
+        queries
+        for queries in (expressions or list(registry.values()))
+        if queries.table != MigrationExpressions.table
+    ]
+    results = await asyncio.gather(
+        *(ensure_schema(queries, existing, applied) for queries in targets),
+        return_exceptions=True,
+    )
+    for queries, result in zip(targets, results):
+        if isinstance(result, Exception):
+            logging.error("couldn't bootstrap table %s: %s", queries.table, result)
+    logging.info(
+        "bootstrapped %s tables in %.3fs", len(targets), time.time() - start_time
+    )
+
 
 class PGInterface:
     """Implements an abstraction for both sync and async PG requests:
@@ -135,22 +437,12 @@ class PGInterface:
             f'{self.table}{"_fake" if not self.database else ""}_interface'
         )
 
-    def finish_init(self) -> None:
-        """Optionally triggers creating tables and checks existence."""
-        if not pool.pool:
+    async def finish_init(self) -> None:
+        """Creates this interface's table, indexes and pending migrations if needed."""
+        if not isinstance(self.database, str) or not self.database:
             self.logger.warning("RUNNING IN FAKE MODE")
-        if pool.pool and self.table and not self.sync_exists():
-            if AUTOCREATE:
-                self.sync_create_table()
-                self.logger.warning(f"building table {self.table}")
-            else:
-                self.logger.warning(
-                    f"not autocreating! table: {self.table} does not exist!"
-                )
-        for k in self.queries:
-            if AUTOCREATE and "create" in k and "index" in k:
-                self.logger.info(f"creating index via {k}")
-                getattr(self, f"sync_{k}")()
+            return
+        await bootstrap_schema(self.database, [self.queries])
 
     _autocreating_table = False
 
@@ -160,7 +452,6 @@ class PGInterface:
         *args: Any,
     ) -> Optional[list[asyncpg.Record]]:
         """Invoke the asyncpg connection's `_execute` given a provided query string and set of arguments"""
-        timeout: int = 180
         if not pool.pool and not isinstance(self.database, dict):
             await pool.connect(self.database, self.table)
         if pool.pool:
@@ -176,28 +467,105 @@ class PGInterface:
                 #     """
                 # )
                 # return self.execute(qstring, *args, timeout=timeout)
-                # _execute takes query, args, limit, timeout
-                try:
-                    result = await connection._execute(
-                        qstring, args, 0, timeout, return_status=True
-                    )
-                    # list[asyncpg.Record], str, bool
-                except asyncpg.UndefinedTableError:
-                    if self._autocreating_table:
-                        logging.error(
-                            "would try creating the table, but we already tried to do that"
-                        )
-                        raise
-                    self._autocreating_table = True
-                    logging.info("creating table %s", self.table)
-                    await self.create_table()
-                    self._autocreating_table = False
-                    result = await connection._execute(
-                        qstring, args, 0, timeout, return_status=True
-                    )
-                return result[0]
+                return await self.execute_on(connection, qstring, *args)
         return None
 
+    async def execute_on(
+        self, connection: asyncpg.Connection, qstring: str, *args: Any
+    ) -> Optional[list[asyncpg.Record]]:
+        """Execute a query on a specific connection, creating the table if it's missing
+        (unless we're inside a transaction, which the error has already aborted)"""
+        timeout: int = 180
+        # _execute takes query, args, limit, timeout
+        try:
+            result = await connection._execute(
+                qstring, args, 0, timeout, return_status=True
+            )
+            # list[asyncpg.Record], str, bool
+        except asyncpg.UndefinedTableError:
+            if self._autocreating_table or connection.is_in_transaction():
+                logging.error(
+                    "would try creating the table, but we already tried to do that"
+                )
+                raise
+            self._autocreating_table = True
+            logging.info("creating table %s", self.table)
+            await self.create_table()
+            self._autocreating_table = False
+            result = await connection._execute(
+                qstring, args, 0, timeout, return_status=True
+            )
+        return result[0]
+
+    @asynccontextmanager
+    async def pipeline(self) -> AsyncGenerator["PinnedInterface", None]:
+        """Pins one pool connection for a sequence of queries, avoiding an acquire per query.
+        The yielded object exposes the same named queries as this interface."""
+        if not pool.pool and not isinstance(self.database, dict):
+            await pool.connect(self.database, self.table)
+        if not pool.pool:
+            yield PinnedInterface(self, None)
+            return
+        async with pool.acquire() as connection:
+            yield PinnedInterface(self, connection)
+
+    @asynccontextmanager
+    async def transaction(
+        self, **kwargs: Any
+    ) -> AsyncGenerator["PinnedInterface", None]:
+        """Like pipeline, but runs the block in a transaction that's rolled back if it raises.
+        kwargs (isolation, readonly, deferrable) are passed to asyncpg's Connection.transaction,
+        and SELECT ... FOR UPDATE row locks are held until the block exits."""
+        async with self.pipeline() as pinned:
+            if not pinned.connection:
+                yield pinned
+                return
+            async with pinned.connection.transaction(**kwargs):
+                yield pinned
+
+    async def subscribe(self, callback: ChangeCallback) -> None:
+        """Call callback on the event loop whenever a row in this table changes.
+        Requires the trigger installed by install_notify_trigger."""
+        if isinstance(self.database, str) and self.database:
+            await change_feed.subscribe(
+                self.database, f"{self.table}_changes", callback
+            )
+
+    async def install_notify_trigger(self, key_column: str) -> None:
+        """(Re)creates the trigger that notifies <table>_changes on every insert, update and delete,
+        including the row's key_column in the payload"""
+        if not pool.pool and not isinstance(self.database, dict):
+            await pool.connect(self.database, self.table)
+        if not pool.pool:
+            return
+        async with pool.acquire() as connection:
+            await connection.execute(NOTIFY_FUNCTION)
+            await connection.execute(
+                NOTIFY_TRIGGER.format(table=self.table, key_column=key_column)
+            )
+
+    async def timed_execute(
+        self,
+        expression: str,
+        qstring: str,
+        *args: Any,
+        connection: Optional[asyncpg.Connection] = None,
+    ) -> Optional[list[asyncpg.Record]]:
+        """Execute a named expression, optionally on a pinned connection,
+        recording its latency and row count"""
+        start_time = time.time()
+        if connection:
+            resp = await self.execute_on(connection, qstring, *args)
+        else:
+            resp = await self.execute(qstring, *args)
+        elapsed = time.time() - start_time
+        self.logger.debug(
+            f"{qstring} {self.truncate(str(args))} -> {self.truncate(f'{resp}')}"
+        )
+        logging.info("query %s took %.4fs", expression, elapsed)
+        record_query(self.table, expression, args, elapsed, resp)
+        return resp
+
     def sync_execute(self, qstring: str, *args: Any) -> asyncpg.Record:
         """Synchronous wrapper for `self.execute`"""
         ret = self.loop.run_until_complete(self.execute(qstring, *args))
@@ -228,14 +596,15 @@ class PGInterface:
             return object.__getattribute__(self, key)
         except AttributeError:
             pass
-        if key.startswith(
-            "sync_"
-        ):  # sync_ prefix implicitly wraps query as synchronous
-            qstring = key.replace("sync_", "")
-            executer = self.sync_execute
-        else:
-            executer = self.execute
-            qstring = key
+        return self.bind_query(key)
+
+    def bind_query(
+        self, key: str, connection: Optional[asyncpg.Connection] = None
+    ) -> Callable[..., asyncpg.Record]:
+        """Build the method for the statement named key, optionally bound to a pinned connection"""
+        # sync_ prefix implicitly wraps query as synchronous
+        sync = key.startswith("sync_")
+        qstring = key.removeprefix("sync_")
         try:
             statement = self.queries.get_query(qstring)
         except KeyError as e:
@@ -264,7 +633,6 @@ class PGInterface:
             def executer_with_args(*args: Any) -> Any:
                 """Closure over 'statement' in local state for application to arguments.
                 Allows deferred execution of f-strs, allowing PGExpresssions to operate on `args`."""
-                start_time = time.time()
                 rebuilt_statement = eval(f'f"{statement}"')  # pylint: disable=eval-used
                 if (
                     rebuilt_statement != statement
@@ -272,22 +640,40 @@ class PGInterface:
                     and "$1" not in statement
                 ):
                     args = ()
-                resp = executer(rebuilt_statement, *args)
-                short_strresp = self.truncate(f"{resp}")
-                short_args = self.truncate(str(args))
-                self.logger.debug(
-                    f"{rebuilt_statement} {short_args} -> {short_strresp}"
-                )
-                elapsed = f"{time.time() - start_time:.4f}s"  # round to miliseconds
-                logging.info(
-                    "query %s took %s", self.truncate(rebuilt_statement), elapsed
+                resp = self.timed_execute(
+                    qstring, rebuilt_statement, *args, connection=connection
                 )
+                if sync:
+                    return self.loop.run_until_complete(resp)
                 return resp
 
             return executer_with_args
 
         def executer_without_args() -> Any:
             """Closure over local state for executer without arguments."""
-            return executer(statement)
+            resp = self.timed_execute(qstring, statement, connection=connection)
+            if sync:
+                return self.loop.run_until_complete(resp)
+            return resp
 
         return executer_without_args
+
+
+class PinnedInterface:
+    """A PGInterface's named queries bound to one connection, see PGInterface.pipeline"""
+
+    def __init__(
+        self, interface: PGInterface, connection: Optional[asyncpg.Connection]
+    ) -> None:
+        self.interface = interface
+        self.connection = connection
+
+    async def execute(self, qstring: str, *args: Any) -> Optional[list[asyncpg.Record]]:
+        if not self.connection:
+            return await self.interface.execute(qstring, *args)
+        return await self.interface.execute_on(self.connection, qstring, *args)
+
+    def __getattr__(self, key: str) -> Callable[..., asyncpg.Record]:
+        if key.startswith("sync_"):
+            raise ValueError(f"{key}: pinned connections can't be used synchronously")
+        return self.interface.bind_query(key, self.connection)
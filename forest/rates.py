@@ -0,0 +1,152 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+USD/MOB exchange rate service.
+Rates are fetched from every configured source in the background and the median
+is kept, so callers always get the last good rate immediately.
+
+RATE_SOURCES is a comma-separated list of built-in source names, or of
+name=url#dotted.path entries for custom sources, e.g. a local stand-in for tests:
+RATE_SOURCES=local=http://localhost:8080/rate#data.price
+FIXED_RATE skips fetching entirely and always returns that rate.
+"""
+
+import asyncio
+import logging
+import statistics
+import time
+from typing import Any, Optional
+
+import aiohttp
+from prometheus_client import Counter, Gauge
+
+from forest import utils
+
+# name -> (url, dotted path to the price in the response)
+SOURCES = {
+    "bigone": (
+        "https://big.one/api/xn/v1/asset_pairs/8e900cb1-6331-4fe7-853c-d678ba136b2f",
+        "data.ticker.close",
+    ),
+    "coinbase": ("https://api.coinbase.com/v2/prices/MOB-USD/spot", "data.amount"),
+    "coingecko": (
+        "https://api.coingecko.com/api/v3/simple/price?ids=mobilecoin&vs_currencies=usd",
+        "mobilecoin.usd",
+    ),
+}
+REFRESH_INTERVAL = float(utils.get_secret("RATE_REFRESH_INTERVAL") or 300)
+# served if no source has ever answered
+FALLBACK_RATE = 14.0
+
+mob_rate = Gauge("mob_usd_rate", "Median USD/MOB rate across sources")
+mob_rate_age = Gauge("mob_usd_rate_age_seconds", "Seconds since the rate was updated")
+rate_failures = Counter("rate_source_failures", "Failed rate fetches", ["source"])
+
+
+def parse_sources(spec: str) -> dict[str, tuple[str, str]]:
+    sources = {}
+    for entry in filter(None, spec.replace(" ", "").split(",")):
+        if "=" in entry:
+            name, url_path = entry.split("=", 1)
+            url, _, path = url_path.partition("#")
+            sources[name] = (url, path)
+        elif entry in SOURCES:
+            sources[entry] = SOURCES[entry]
+        else:
+            logging.error("unknown rate source %s", entry)
+    return sources
+
+
+def dig(blob: Any, path: str) -> float:
+    for key in filter(None, path.split(".")):
+        blob = blob[key]
+    return float(blob)
+
+
+class RateService:
+    """Keeps a fresh USD/MOB rate. The refresh task is started by the first get_rate()"""
+
+    def __init__(
+        self,
+        sources: Optional[dict[str, tuple[str, str]]] = None,
+        interval: float = REFRESH_INTERVAL,
+        fixed_rate: Optional[float] = None,
+    ) -> None:
+        self.sources = (
+            sources
+            if sources is not None
+            else parse_sources(utils.get_secret("RATE_SOURCES") or "bigone,coinbase")
+        )
+        self.interval = interval
+        self.rate = fixed_rate
+        self.fixed = fixed_rate is not None
+        self.updated = time.time() if self.fixed else 0.0
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.task: Optional[asyncio.Task] = None
+        self.first_refresh: Optional[asyncio.Task] = None
+
+    async def fetch(self, name: str) -> Optional[float]:
+        url, path = self.sources[name]
+        if not self.session or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=10)
+            )
+        try:
+            async with self.session.get(url) as resp:
+                return dig(await resp.json(content_type=None), path)
+        except (
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+            KeyError,
+            IndexError,
+            TypeError,
+            ValueError,
+        ) as e:
+            rate_failures.labels(name).inc()
+            logging.warning("couldn't get rate from %s: %s", name, repr(e))
+            return None
+
+    async def refresh(self) -> None:
+        "Fetches every source and keeps the median. Keeps the last rate if all fail"
+        rates = [
+            rate
+            for rate in await asyncio.gather(*map(self.fetch, self.sources))
+            if rate
+        ]
+        if rates:
+            self.rate = statistics.median(rates)
+            self.updated = time.time()
+            mob_rate.set(self.rate)
+        else:
+            logging.error("no rate sources answered, keeping %s", self.rate)
+
+    async def run(self) -> None:
+        while 1:
+            await asyncio.sleep(self.interval)
+            await self.refresh()
+
+    async def get_rate(self) -> float:
+        "Returns the last good rate without waiting on the network, except on first use"
+        if not self.fixed:
+            if not self.first_refresh:
+                self.first_refresh = asyncio.create_task(self.refresh())
+            if not self.task or self.task.done():
+                self.task = asyncio.create_task(self.run())
+            if self.rate is None:
+                await asyncio.shield(self.first_refresh)
+        return self.rate if self.rate is not None else FALLBACK_RATE
+
+    def age(self) -> float:
+        return time.time() - self.updated if self.updated else float("inf")
+
+    async def close(self) -> None:
+        if self.task:
+            self.task.cancel()
+        if self.session:
+            await self.session.close()
+
+
+fixed_rate = utils.get_secret("FIXED_RATE")
+rate_service = RateService(fixed_rate=float(fixed_rate) if fixed_rate else None)
+mob_rate_age.set_function(rate_service.age)
@@ -0,0 +1,239 @@
+#!/usr/bin/python3.9
+# Copyright (c) 2022 MobileCoin Inc.
+# Copyright (c) 2022 The Forest Team
+"""
+Background UTXO inventory.
+Keeps an in-memory view of the account's unspent TXOs that's refreshed in the
+background, lets concurrent payers reserve specific TXOs so they don't collide,
+and splits large TXOs ahead of time so that payouts don't wait on splitting.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from prometheus_client import Gauge
+
+from forest import utils
+from forest.payments_monitor import MICROMOB_TO_PICOMOB, MILLIMOB_TO_PICOMOB, Mobster
+
+REFRESH_INTERVAL = float(utils.get_secret("UTXO_REFRESH_INTERVAL") or 30)
+# reservations that are neither spent nor released in time go back into the pool
+RESERVATION_TIMEOUT = float(utils.get_secret("UTXO_RESERVATION_TIMEOUT") or 600)
+# each split output carries this much extra to pay the fee of the payment using it
+PAYMENT_FEE_PMOB = 400 * MICROMOB_TO_PICOMOB
+# a transaction has at most 16 outputs, one of which is change
+SPLIT_OUTPUTS = 15
+
+utxo_count = Gauge(
+    "utxo_inventory", "Unspent TXOs known to the UTXO manager", ["state"]
+)
+
+
+def denomination(amount_mmob: int) -> int:
+    "Value in pmob of a TXO that can pay amount_mmob on its own"
+    return amount_mmob * MILLIMOB_TO_PICOMOB + PAYMENT_FEE_PMOB
+
+
+def parse_targets(spec: str) -> dict[int, int]:
+    """Parses UTXO_TARGETS, e.g. "100:50,1000:10" keeps 50 TXOs ready for 100mmob payments
+    and 10 for 1000mmob payments. Returns {denomination pmob: count}"""
+    targets = {}
+    for pair in filter(None, spec.replace(" ", "").split(",")):
+        amount_mmob, count = pair.split(":")
+        targets[denomination(int(amount_mmob))] = int(count)
+    return targets
+
+
+class UTXOManager:
+    """Tracks unspent TXOs, hands out reservations, and keeps UTXO targets stocked.
+    The background task is started by the first reservation."""
+
+    def __init__(
+        self, mobster: Mobster, targets: Optional[dict[int, int]] = None
+    ) -> None:
+        self.mobster = mobster
+        # txo id -> value in pmob
+        self.inventory: dict[str, int] = {}
+        # txo id -> when the reservation expires
+        self.reservations: dict[str, float] = {}
+        # denomination pmob -> how many TXOs of it to keep available
+        self.targets = (
+            targets
+            if targets is not None
+            else parse_targets(utils.get_secret("UTXO_TARGETS") or "")
+        )
+        # extra TXOs requested by payers currently waiting on the splitter
+        self.demand: dict[int, int] = {}
+        self.refreshed = 0.0
+        self.changed = asyncio.Event()
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def notify(self) -> None:
+        utxo_count.labels("reserved").set(len(self.reservations))
+        utxo_count.labels("free").set(len(self.inventory) - len(self.reservations))
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def refresh(self) -> None:
+        """Applies the difference between full-service's unspent TXOs and the inventory"""
+        unspent = await self.mobster.get_utxos()
+        spent = self.inventory.keys() - unspent.keys()
+        added = unspent.keys() - self.inventory.keys()
+        for txo in spent:
+            self.inventory.pop(txo)
+            self.reservations.pop(txo, None)
+        for txo in added:
+            self.inventory[txo] = unspent[txo]
+        self.refreshed = time.time()
+        if spent or added:
+            logging.info("utxos: %s spent, %s new", len(spent), len(added))
+        self.notify()
+
+    def free(self, min_pmob: int, max_pmob: Optional[int] = None) -> list[str]:
+        "Unreserved TXOs worth at least min_pmob (and less than max_pmob), smallest first"
+        now = time.time()
+        for txo, expiry in list(self.reservations.items()):
+            if expiry < now:
+                self.reservations.pop(txo)
+        return sorted(
+            (
+                txo
+                for txo, value in self.inventory.items()
+                if txo not in self.reservations
+                and value >= min_pmob
+                and (max_pmob is None or value < max_pmob)
+            ),
+            key=self.inventory.__getitem__,
+        )
+
+    def reserve(
+        self, min_pmob: int, count: int = 1, max_pmob: Optional[int] = None
+    ) -> list[str]:
+        "Reserves up to count of the smallest free TXOs worth at least min_pmob"
+        txos = self.free(min_pmob, max_pmob)[:count]
+        expiry = time.time() + RESERVATION_TIMEOUT
+        for txo in txos:
+            self.reservations[txo] = expiry
+        self.notify()
+        return txos
+
+    async def acquire(
+        self, min_pmob: int, count: int = 1, timeout: float = 0
+    ) -> list[str]:
+        """Reserves count TXOs worth at least min_pmob. If there aren't enough,
+        asks the splitter for more and waits up to timeout seconds for them.
+        May return fewer than count TXOs."""
+        self.ensure_running()
+        if not self.refreshed:
+            await self.refresh()
+        if len(self.free(min_pmob)) >= count or not timeout:
+            return self.reserve(min_pmob, count)
+        # leave TXOs big enough to split for the splitter, and wait for its outputs
+        split_size = 2 * min_pmob + PAYMENT_FEE_PMOB
+        txos = self.reserve(min_pmob, count, split_size)
+        missing = count - len(txos)
+        self.demand[min_pmob] = self.demand.get(min_pmob, 0) + missing
+        self.wakeup.set()
+        deadline = time.time() + timeout
+        try:
+            while len(txos) < count and time.time() < deadline:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), deadline - time.time())
+                except asyncio.TimeoutError:
+                    break
+                txos += self.reserve(min_pmob, count - len(txos), split_size)
+        finally:
+            self.demand[min_pmob] -= missing
+            if not self.demand[min_pmob]:
+                self.demand.pop(min_pmob)
+        # out of time, so settle for whatever's big enough
+        return txos + self.reserve(min_pmob, count - len(txos))
+
+    def release(self, txos: list[str]) -> None:
+        "Returns reserved TXOs that weren't used to the pool"
+        for txo in txos:
+            self.reservations.pop(txo, None)
+        self.notify()
+
+    def spend(self, txos: list[str]) -> None:
+        """Drops TXOs that were used in a transaction. If the transaction didn't go
+        through, the next refresh adds them back."""
+        for txo in txos:
+            self.inventory.pop(txo, None)
+            self.reservations.pop(txo, None)
+        self.notify()
+
+    async def split(self, value_pmob: int, count: int) -> int:
+        """Splits the largest free TXO into up to count outputs of value_pmob each,
+        waiting for the transaction to land. Returns how many outputs were made."""
+        sources = self.free(2 * value_pmob + PAYMENT_FEE_PMOB)
+        if not sources:
+            logging.warning("no TXO large enough to split into %spmob", value_pmob)
+            return 0
+        source = sources[-1]
+        self.reservations[source] = time.time() + RESERVATION_TIMEOUT
+        outputs = min(
+            count,
+            SPLIT_OUTPUTS,
+            (self.inventory[source] - PAYMENT_FEE_PMOB) // value_pmob,
+        )
+        built = await self.mobster.req_(
+            "build_split_txo_transaction",
+            txo_id=source,
+            output_values=[str(value_pmob)] * outputs,
+        )
+        prop = built.get("result", {}).get("tx_proposal")
+        submitted = (
+            await self.mobster.req_(
+                "submit_transaction",
+                tx_proposal=prop,
+                account_id=await self.mobster.get_account(),
+            )
+            if prop
+            else {}
+        )
+        tx_id = submitted.get("result", {}).get("transaction_log", {}).get(
+            "transaction_log_id"
+        ) or built.get("result", {}).get("transaction_log_id")
+        if not submitted.get("result"):
+            self.release([source])
+            return 0
+        self.spend([source])
+        if tx_id:
+            await self.mobster.transaction_watcher.wait(tx_id, 60)
+        await self.refresh()
+        return outputs
+
+    async def restock(self) -> None:
+        "Splits TXOs until every target and waiting payer has enough"
+        wanted: dict[int, int] = {}
+        for wants in (self.targets, self.demand):
+            for value, count in wants.items():
+                wanted[value] = wanted.get(value, 0) + count
+        for value, count in sorted(wanted.items(), reverse=True):
+            missing = count - len(self.free(value, 2 * value))
+            while missing > 0:
+                built = await self.split(value, missing)
+                if not built:
+                    break
+                missing -= built
+
+    def ensure_running(self) -> None:
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        while 1:
+            self.wakeup.clear()
+            try:
+                await self.refresh()
+                await self.restock()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("couldn't maintain utxos")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), REFRESH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
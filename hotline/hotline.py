@@ -10,7 +10,7 @@ import logging
 from decimal import Decimal
 from typing import Optional
 
-from forest import utils
+from forest import payouts, utils
 from forest.core import (
     Message,
     Response,
@@ -334,70 +334,40 @@ class Hotline(DialogBot):  # pylint: disable=too-many-public-methods
         if not await self.ask_yesno_question(msg.uuid):
             return "OK, canceling"
         async with self.pay_lock:
-            valid_utxos = [
-                utxo
-                for utxo, upmob in (await self.mobster.get_utxos()).items()
-                if upmob > (1_000_000_000 * (amount_mmob + 1))
-            ]
-            if len(valid_utxos) < len(filtered_send_list):
-                await self.send_message(
-                    msg.uuid,
-                    "Please wait! Insufficient number of utxos!\nBuilding more...",
-                )
-                building_msg = await self.mobster.split_txos_slow(
-                    amount_mmob + 1, (len(filtered_send_list) - len(valid_utxos))
-                )
-                await self.send_message(msg.uuid, building_msg)
-                valid_utxos = [
-                    utxo
-                    for utxo, upmob in (await self.mobster.get_utxos()).items()
-                    if upmob > (1_000_000_000 * (amount_mmob + 1))
-                ]
-            failed = []
 
-            async def pay_logging_success(
-                target: str,
-                amount_mmob: int,
-                message: str = "",
-                input_txo_ids: Optional[list[str]] = None,
-            ) -> Optional[Message]:
-                if not input_txo_ids:
-                    input_txo_ids = []
-                try:
-                    await self.send_typing(recipient=target)
-                    result = await self.send_payment(
-                        recipient=target,
-                        amount_pmob=amount_mmob * 1_000_000_000,
-                        receipt_message=message,
-                        input_txo_ids=input_txo_ids,
-                        confirm_tx_timeout=60,
-                    )
-                    await asyncio.sleep(0.5)
+            async def pay(target: str, txo: str) -> bool:
+                await self.send_typing(recipient=target)
+                result = await self.send_payment(
+                    recipient=target,
+                    amount_pmob=amount_mmob * 1_000_000_000,
+                    receipt_message=message,
+                    input_txo_ids=[txo],
+                    confirm_tx_timeout=60,
+                )
+                # if we didn't get a result indicating success
+                if not result or result.status != "tx_status_succeeded":
                     await self.send_typing(recipient=target, stop=True)
-                    # if we didn't get a result indicating success
-                    if not result or (
-                        result and result.status != "tx_status_succeeded"
-                    ):
-                        # stash as failed
-                        return None
-                    # persist user as successfully paid
-                    await self.successful_pays.extend(save_key, target)
-                    await self.payout_balance_mmob.decrement(list_, amount_mmob)
-                    await self.send_message(target, "I've sent you a payment!")
-                    return result
-                except Exception:  # pylint: disable=broad-except
-                    return None
+                    return False
+                return True
 
-            results = [
-                await pay_logging_success(
-                    target,
-                    amount_mmob,
-                    message,
-                    input_txo_ids=[valid_utxos.pop(0) or ""],
-                )
-                for target in filtered_send_list
-            ]
-            failed = [filtered_send_list[i] for (i, x) in enumerate(results) if not x]
+            # only runs once the payout engine has persisted target as paid
+            async def paid(target: str) -> None:
+                await self.send_typing(recipient=target, stop=True)
+                await self.payout_balance_mmob.decrement(list_, amount_mmob)
+                await self.send_message(target, "I've sent you a payment!")
+
+            async def report(text: str) -> None:
+                await self.send_message(msg.uuid, text)
+
+            failed = await payouts.PayoutEngine(self.utxos).run(
+                filtered_send_list,
+                1_000_000_000 * (amount_mmob + 1),
+                pay,
+                report,
+                paid_store=self.successful_pays,
+                paid_key=save_key,
+                on_paid=paid,
+            )
             if len(failed):
                 await self.send_message(
                     msg.uuid,
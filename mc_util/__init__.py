@@ -127,6 +127,23 @@ def b64_receipt_to_full_service_receipt(b64_string: str) -> dict:
     return full_service_receipt
 
 
+def tx_proposal_outlay_public_keys(tx_proposal: dict) -> Optional[list]:
+    """Hex public key of each outlay's TxOut in a full-service tx_proposal, in outlay order.
+    These match the public_key of the receiver receipts for the proposal.
+    None if the proposal doesn't carry its tx_proto and outlay mapping"""
+    tx_proto = tx_proposal.get("tx_proto")
+    index_map = tx_proposal.get("outlay_index_to_tx_out_index")
+    if not tx_proto or not index_map:
+        return None
+    tx = external_pb2.Tx.FromString(bytes.fromhex(tx_proto))
+    pairs = index_map.items() if isinstance(index_map, dict) else index_map
+    tx_out_indexes = {int(outlay): int(tx_out) for outlay, tx_out in pairs}
+    return [
+        tx.prefix.outputs[tx_out_indexes[outlay]].public_key.SerializeToString().hex()
+        for outlay in sorted(tx_out_indexes)
+    ]
+
+
 def full_service_receipt_to_b64_receipt(full_service_receipt: dict) -> str:
     """Convert a full-service receipt object to a b64-encoded protobuf Receipt"""
     assert full_service_receipt["object"] == "receiver_receipt"
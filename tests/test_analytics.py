@@ -0,0 +1,53 @@
+import datetime
+import os
+
+# Prevent Utils from importing dev_secrets by default
+os.environ["ENV"] = "test"
+
+from forest.analytics import RETENTION_DAYS, ActiveUsers, HyperLogLog, today
+
+
+def test_hyperloglog_estimate() -> None:
+    """Estimates should be within a few percent of the true cardinality"""
+    sketch = HyperLogLog()
+    for i in range(20000):
+        sketch.add(f"user-{i}")
+        # duplicates don't change the estimate
+        sketch.add(f"user-{i}")
+    assert abs(sketch.count() - 20000) < 20000 * 0.03
+    small = HyperLogLog()
+    for i in range(10):
+        small.add(f"user-{i}")
+    assert small.count() == 10
+
+
+def test_hyperloglog_merge() -> None:
+    """Merging sketches estimates the union, and sketches survive serialization"""
+    first, second = HyperLogLog(), HyperLogLog()
+    for i in range(3000):
+        first.add(f"user-{i}")
+    for i in range(2000, 5000):
+        second.add(f"user-{i}")
+    union = HyperLogLog(bytes(first)).merge(second)
+    assert abs(union.count() - 5000) < 5000 * 0.03
+    assert bytes(HyperLogLog(bytes(union))) == bytes(union)
+
+
+def test_active_users() -> None:
+    active = ActiveUsers("bot")
+    for user in ["a", "b", "a", "c"]:
+        active.add(user)
+    assert active.count(1) == 3
+    assert active.count(30) == 3
+
+
+def test_prune_keeps_unwritten_days() -> None:
+    active = ActiveUsers("bot")
+    old = today() - datetime.timedelta(days=RETENTION_DAYS + 1)
+    active.sketches[old] = HyperLogLog()
+    active.dirty.add(old)
+    active.prune()
+    assert old in active.sketches
+    active.dirty.clear()
+    active.prune()
+    assert old not in active.sketches
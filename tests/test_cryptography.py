@@ -0,0 +1,32 @@
+import os
+
+# Prevent Utils from importing dev_secrets by default
+os.environ["ENV"] = "test"
+
+import base58
+import gzip
+
+from forest import cryptography
+from forest.cryptography import (
+    AESKEY,
+    encrypt,
+    get_ciphertext_value,
+    get_cleartext_value,
+)
+
+
+def test_reads_v1_and_v2() -> None:
+    legacy = base58.b58encode(encrypt(gzip.compress(b"hello"), AESKEY)).decode()
+    assert get_cleartext_value(legacy) == "hello"
+    for value in ("", "short", "long " * 1000):
+        encoded = get_ciphertext_value(value)
+        assert encoded.startswith(cryptography.TEXT_PREFIX)
+        assert get_cleartext_value(encoded) == value
+
+
+def test_header_names_codec() -> None:
+    v2, cipher = cryptography.ENVELOPE_V2, cryptography.CIPHER_AES_EAX
+    assert cryptography.seal(b"tiny")[:3] == bytes([v2, cryptography.CODEC_RAW, cipher])
+    big = cryptography.seal(b"x" * 1000)
+    assert big[:3] == bytes([v2, cryptography.CODEC_GZIP, cipher])
+    assert cryptography.unseal(big) == b"x" * 1000
@@ -0,0 +1,207 @@
+import os
+
+# Prevent Utils from importing dev_secrets by default
+os.environ["ENV"] = "test"
+os.environ.setdefault("PAUTH", "test")
+
+import asyncio
+from typing import AsyncIterator
+
+import aiohttp
+import pytest
+import pytest_asyncio
+from aiohttp import web
+
+from forest import pdictng
+from forest.pdictng import aPersistDict, aPersistDictOfInts, aPersistDictOfLists
+
+# a tiny stand-in for the upstash REST API
+STRINGS: dict[str, str] = {}
+HASHES: dict[str, dict[str, str]] = {}
+WRITES: list[int] = []
+READS: list[str] = []
+
+
+async def command(request: web.Request) -> web.Response:
+    cmd, *args = request.match_info["path"].split("/")
+    body = await request.text()
+    if body:
+        WRITES.append(len(body))
+        args.append(body)
+    else:
+        READS.append(cmd)
+    if cmd == "SET":
+        STRINGS[args[0]] = args[1]
+        return web.json_response({"result": "OK"})
+    if cmd == "GET":
+        return web.json_response({"result": STRINGS.get(args[0])})
+    if cmd == "HSET":
+        HASHES.setdefault(args[0], {})[args[1]] = args[2]
+        return web.json_response({"result": 1})
+    if cmd == "HDEL":
+        return web.json_response({"result": int(bool(HASHES[args[0]].pop(args[1])))})
+    if cmd == "HGETALL":
+        pairs = HASHES.get(args[0], {}).items()
+        return web.json_response({"result": [item for pair in pairs for item in pair]})
+    return web.json_response({"error": "unknown command"}, status=400)
+
+
+async def start_server(port: int = 0) -> web.AppRunner:
+    "Serve the fake store, on a free port unless one is given, and point dicts at it"
+    app = web.Application()
+    app.router.add_route("*", "/{path:.*}", command)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    pdictng.pURL = f"http://127.0.0.1:{runner.addresses[0][1]}"
+    return runner
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def close_sessions(monkeypatch: pytest.MonkeyPatch) -> AsyncIterator[None]:
+    "Close the client session of every dict a test makes"
+    sessions: list[aiohttp.ClientSession] = []
+
+    def open_session() -> aiohttp.ClientSession:
+        sessions.append(session := aiohttp.client.ClientSession())
+        return session
+
+    # restored afterwards, since start_server points pURL at the fake store
+    monkeypatch.setattr(pdictng, "pURL", pdictng.pURL)
+    monkeypatch.setattr(pdictng.aiohttp, "ClientSession", open_session)
+    yield
+    await asyncio.gather(*(session.close() for session in sessions))
+
+
+@pytest.mark.asyncio
+async def test_keys_layout_migrates_blob() -> None:
+    runner = await start_server()
+    try:
+        old = aPersistDictOfLists[str]("test_migrate", layout="blob")
+        await old.init_task
+        await old.extend("alice", "a")
+        await old.set("bob", ["b"])
+        await old.set("carol", ["c"])
+        assert len(HASHES) == 0
+
+        new = aPersistDictOfLists[str]("test_migrate", layout="keys")
+        await new.init_task
+        assert await new.get("alice") == ["a"]
+        assert sorted(await new.keys()) == ["alice", "bob", "carol"]
+        # each key is a record, plus the migration marker
+        assert len(list(HASHES.values())[0]) == 4
+
+        # writes only upload the key that changed
+        WRITES.clear()
+        await new.extend("alice", "aa")
+        await new.remove("carol")
+        assert len(WRITES) == 1
+        assert WRITES[0] < len(max(STRINGS.values(), key=len))
+
+        # an emptied dict stays empty rather than reloading the old blob
+        await new.remove("alice")
+        await new.remove("bob")
+        reloaded = aPersistDict[list[str]]("test_migrate", layout="keys")
+        await reloaded.init_task
+        assert await reloaded.keys() == []
+        await new.set("dave", ["d"])
+        reloaded = aPersistDict[list[str]]("test_migrate", layout="keys")
+        await reloaded.init_task
+        assert await reloaded.items() == [("dave", ["d"])]
+        assert pdictng.LAYOUT_MARKER not in await reloaded.keys()
+    finally:
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("layout", ["blob", "keys"])
+async def test_write_behind_coalesces(layout: str) -> None:
+    runner = await start_server()
+    try:
+        counts = aPersistDictOfInts(
+            f"test_{layout}_behind", layout=layout, write_delay=0.1
+        )
+        await counts.init_task
+        WRITES.clear()
+        for _ in range(20):
+            await counts.increment("a", 1)
+            await counts.increment("b", 2)
+        # applied at once, uploaded later
+        assert await counts.get("a") == 20
+        assert not WRITES
+        await asyncio.sleep(0.3)
+        assert len(WRITES) == (1 if layout == "blob" else 2)
+        await counts.increment("a", 1)
+        await pdictng.flush_all()
+        assert not counts.dirty
+        reloaded = aPersistDictOfInts(f"test_{layout}_behind", layout=layout)
+        await reloaded.init_task
+        assert sorted(await reloaded.items()) == [("a", 21), ("b", 40)]
+    finally:
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("layout", ["blob", "keys"])
+async def test_snapshot_warm_start(layout: str, tmp_path: str) -> None:
+    runner = await start_server()
+    try:
+        name = f"test_{layout}_snapshot"
+        first = aPersistDict[str](name, layout=layout, snapshot_dir=tmp_path)
+        await first.init_task
+        await first.set("a", "1")
+        await first.save_snapshot()
+
+        # the version comes with the data, so checking it is one read and no writes
+        READS.clear()
+        WRITES.clear()
+        warm = aPersistDict[str](name, layout=layout, snapshot_dir=tmp_path)
+        assert await warm.get("a") == "1"
+        await warm.init_task
+        assert READS == (["GET"] if layout == "blob" else ["HGETALL"])
+        assert warm.versions == first.versions and not WRITES
+
+        # a writer without snapshots versions its writes too, so they're picked up
+        plain = aPersistDict[str](name, layout=layout)
+        await plain.init_task
+        await plain.set("b", "2")
+        stale = aPersistDict[str](name, layout=layout, snapshot_dir=tmp_path)
+        # writes made before reconciling are kept and uploaded afterwards
+        await stale.set("c", "3")
+        assert sorted(await stale.keys()) == ["a", "c"]
+        await stale.init_task
+        assert sorted(await stale.keys()) == ["a", "b", "c"]
+        await pdictng.flush_all()
+        reloaded = aPersistDict[str](name, layout=layout)
+        await reloaded.init_task
+        assert sorted(await reloaded.keys()) == ["a", "b", "c"]
+    finally:
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_snapshot_keeps_writes_if_store_is_down(
+    tmp_path: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    runner = await start_server()
+    try:
+        first = aPersistDict[str]("test_down_snapshot", snapshot_dir=tmp_path)
+        await first.init_task
+        await first.set("a", "1")
+        await first.save_snapshot()
+    finally:
+        port = runner.addresses[0][1]
+        await runner.cleanup()
+    monkeypatch.setattr(pdictng, "RECONCILE_ATTEMPTS", 2)
+    warm = aPersistDict[str]("test_down_snapshot", snapshot_dir=tmp_path)
+    await warm.set("b", "2")
+    await warm.init_task
+    assert not warm.warm and warm.dirty == {"b"}
+    runner = await start_server(port)
+    try:
+        await pdictng.flush_all()
+        reloaded = aPersistDict[str]("test_down_snapshot")
+        await reloaded.init_task
+        assert sorted(await reloaded.items()) == [("a", "1"), ("b", "2")]
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,52 @@
+import os
+
+# Prevent Utils from importing dev_secrets by default
+os.environ["ENV"] = "test"
+
+import pytest
+from aiohttp import web
+
+from forest.rates import FALLBACK_RATE, RateService, parse_sources
+
+PRICES = {"a": 10.0, "b": 12.0, "c": 20.0}
+
+
+async def price(request: web.Request) -> web.Response:
+    name = request.match_info["name"]
+    if name not in PRICES:
+        return web.Response(status=502)
+    return web.json_response({"data": {"price": str(PRICES[name])}})
+
+
+@pytest.mark.asyncio
+async def test_median_of_local_sources(monkeypatch: pytest.MonkeyPatch) -> None:
+    app = web.Application()
+    app.router.add_get("/{name}", price)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    port = runner.addresses[0][1]
+    try:
+        spec = ",".join(
+            f"{name}=http://127.0.0.1:{port}/{name}#data.price" for name in "abcd"
+        )
+        service = RateService(parse_sources(spec))
+        # the broken source is ignored
+        assert await service.get_rate() == 12.0
+        assert service.age() < 5
+        monkeypatch.setitem(PRICES, "b", 30.0)
+        # served from memory until the next refresh
+        assert await service.get_rate() == 12.0
+        await service.refresh()
+        assert await service.get_rate() == 20.0
+        await service.close()
+    finally:
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_fallback_and_fixed_rate() -> None:
+    unreachable = RateService({"down": ("http://127.0.0.1:9/", "price")})
+    assert await unreachable.get_rate() == FALLBACK_RATE
+    await unreachable.close()
+    assert await RateService(fixed_rate=7.5).get_rate() == 7.5